@@ -6,12 +6,29 @@ import asyncio
 import aiosqlite
 import yt_dlp
 import functools
-from datetime import datetime
+from datetime import datetime, timezone
 from collections import deque
 import random
 import math
+import bisect
+import heapq
 import json
 import os
+import re
+import sys
+import time
+import hashlib
+import signal
+import cProfile
+import io
+import pstats
+import threading
+import sqlite3
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs, urlunparse
 # Spotify support
 import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials
@@ -43,7 +60,7 @@ def command_error_handler(func):
     @functools.wraps(func)
     async def wrapper(*args, **kwargs):
         try:
-            return await func(*args, **kwargs)
+            return await command_profiler.run(func, args, kwargs)
         except Exception as e:
             ctx = args[0] if args else None
             if ctx:
@@ -51,10 +68,226 @@ def command_error_handler(func):
             print(f"Error in {func.__name__}: {e}")
     return wrapper
 
+# Track class: one queue/history/playlist entry
+class Track:
+    """Slotted queue entry. Uploader and thumbnail strings are interned so copies of
+    the same track across guilds share them."""
+    __slots__ = ('title', 'duration', 'webpage_url', 'thumbnail', 'uploader', 'requester', 'local_path', 'id')
+
+    def __init__(self, title, duration=None, webpage_url=None, thumbnail=None, uploader=None,
+                 requester=None, local_path=None, id=None):
+        self.title = title
+        self.duration = int(duration) if duration else None
+        self.webpage_url = webpage_url
+        self.thumbnail = sys.intern(thumbnail) if thumbnail else None
+        self.uploader = sys.intern(uploader) if uploader else None
+        self.requester = requester  # User id
+        self.local_path = local_path  # Attachments played from disk
+        self.id = id  # Video id, when known
+
+    @classmethod
+    def from_info(cls, info, requester):
+        """Build from a yt-dlp info dict or search result"""
+        return cls(info.get('title'), info.get('duration'), info.get('webpage_url') or info.get('url'),
+                   info.get('thumbnail'), info.get('uploader'), requester, id=info.get('id'))
+
+    def copy(self):
+        return Track(*(getattr(self, field) for field in Track.__slots__))
+
+    def to_dict(self):
+        """Readable form, used for queue exports. local_path is a path on this host and is left out"""
+        return {field: getattr(self, field) for field in Track.__slots__
+                if field != 'local_path' and getattr(self, field) is not None}
+
+    def to_compact(self):
+        """Positional form (fields in __slots__ order, trailing Nones dropped), used for storage"""
+        values = [getattr(self, field) for field in Track.__slots__]
+        while values and values[-1] is None:
+            values.pop()
+        return values
+
+    @classmethod
+    def from_serialized(cls, value):
+        """Accepts both the compact list form and dicts (exports and rows saved by older versions)"""
+        if isinstance(value, list):
+            return cls(*value)
+        requester = value.get('requester')
+        if isinstance(requester, str):
+            requester = int(requester) if requester.isdigit() else None
+        return cls(value.get('title'), value.get('duration'), value.get('webpage_url'), value.get('thumbnail'),
+                   value.get('uploader'), requester, value.get('local_path'), value.get('id'))
+
+    @classmethod
+    def from_export(cls, value):
+        """A track from a user-supplied file: never trust a local_path in it"""
+        track = cls.from_serialized(value)
+        track.local_path = None
+        return track
+
+def encode_track(track):
+    return json.dumps(track.to_compact(), separators=(',', ':'))
+
+def decode_track(text):
+    return Track.from_serialized(json.loads(text))
+
+def encode_tracks(tracks):
+    return json.dumps([track.to_compact() for track in tracks], separators=(',', ':'))
+
+def decode_tracks(text):
+    return [Track.from_serialized(value) for value in json.loads(text)]
+
+# Queue structure
+QUEUE_CHUNK_SIZE = 256  # Chunks are split at twice this size
+
+class TrackQueue:
+    """Chunked list of tracks. Positional insert/remove/move and page slices only shift one chunk
+    (finding it walks the chunk list, not the tracks), instead of copying the whole queue.
+    Also keeps the total duration up to date, and calls on_change after every mutation."""
+    def __init__(self, tracks=(), on_change=None):
+        self.chunks = []
+        self.length = 0
+        self.total_duration = 0
+        self.on_change = None
+        self.extend(tracks)
+        self.on_change = on_change
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change()
+
+    def __len__(self):
+        return self.length
+
+    def __bool__(self):
+        return self.length > 0
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            yield from chunk
+
+    def _locate(self, index):
+        """(chunk index, offset in chunk) for a queue position"""
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("queue index out of range")
+        for chunk_index, chunk in enumerate(self.chunks):
+            if index < len(chunk):
+                return chunk_index, index
+            index -= len(chunk)
+        raise IndexError("queue index out of range")
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            positions = range(*index.indices(self.length))
+            if not positions:
+                return []
+            low, high = min(positions[0], positions[-1]), max(positions[0], positions[-1])
+            window = self.page(low, high + 1)
+            return [window[position - low] for position in positions]
+        chunk_index, offset = self._locate(index)
+        return self.chunks[chunk_index][offset]
+
+    def page(self, start, stop):
+        """Tracks in [start, stop) without touching the chunks outside it"""
+        result = []
+        position = 0
+        for chunk in self.chunks:
+            if position >= stop:
+                break
+            end = position + len(chunk)
+            if end > start:
+                result.extend(chunk[max(start - position, 0):stop - position])
+            position = end
+        return result
+
+    def _added(self, track):
+        self.length += 1
+        self.total_duration += track.duration or 0
+        self._changed()
+
+    def _removed(self, track):
+        self.length -= 1
+        self.total_duration -= track.duration or 0
+        self._changed()
+
+    def append(self, track):
+        if not self.chunks or len(self.chunks[-1]) >= QUEUE_CHUNK_SIZE:
+            self.chunks.append([])
+        self.chunks[-1].append(track)
+        self._added(track)
+
+    def extend(self, tracks):
+        for track in tracks:
+            self.append(track)
+
+    def insert(self, index, track):
+        if index >= self.length or not self.chunks:
+            self.append(track)
+            return
+        chunk_index, offset = self._locate(max(index, -self.length))
+        chunk = self.chunks[chunk_index]
+        chunk.insert(offset, track)
+        if len(chunk) > 2 * QUEUE_CHUNK_SIZE:
+            self.chunks[chunk_index:chunk_index + 1] = [chunk[:QUEUE_CHUNK_SIZE], chunk[QUEUE_CHUNK_SIZE:]]
+        self._added(track)
+
+    def appendleft(self, track):
+        self.insert(0, track)
+
+    def pop(self, index=-1):
+        chunk_index, offset = self._locate(index)
+        chunk = self.chunks[chunk_index]
+        track = chunk.pop(offset)
+        if not chunk:
+            del self.chunks[chunk_index]
+        elif len(chunk) < QUEUE_CHUNK_SIZE // 4 and chunk_index + 1 < len(self.chunks) \
+                and len(chunk) + len(self.chunks[chunk_index + 1]) <= QUEUE_CHUNK_SIZE:
+            # Fold small leftovers into the next chunk so the chunk list stays short
+            self.chunks[chunk_index:chunk_index + 2] = [chunk + self.chunks[chunk_index + 1]]
+        self._removed(track)
+        return track
+
+    def popleft(self):
+        return self.pop(0)
+
+    def move(self, from_index, to_index):
+        track = self.pop(from_index)
+        self.insert(to_index, track)
+        return track
+
+    def clear(self):
+        self.chunks = []
+        self.length = 0
+        self.total_duration = 0
+        self._changed()
+
+    def shuffle(self, rng=random):
+        """Fisher-Yates over the chunks in place, positions are found by bisecting chunk start offsets"""
+        starts = []
+        position = 0
+        for chunk in self.chunks:
+            starts.append(position)
+            position += len(chunk)
+
+        def locate(index):
+            chunk_index = bisect.bisect_right(starts, index) - 1
+            return self.chunks[chunk_index], index - starts[chunk_index]
+
+        for i in range(self.length - 1, 0, -1):
+            j = rng.randint(0, i)
+            chunk_i, offset_i = locate(i)
+            chunk_j, offset_j = locate(j)
+            chunk_i[offset_i], chunk_j[offset_j] = chunk_j[offset_j], chunk_i[offset_i]
+        self._changed()
+
 # GuildData class (define if not already present)
+IDLE_STATE_FIELDS = frozenset(('last_activity', 'empty_since', 'now_playing', 'stay_24_7', 'auto_disconnect'))
+
 class GuildData:
-    def __init__(self):
-        self.queue = deque()
+    def __init__(self, guild_id=None):
+        self.guild_id = guild_id
+        self.queue = TrackQueue()
         self.loop = False
         self.volume = 0.5  # Set default volume to 50% (normal)
         self.now_playing = None
@@ -67,16 +300,55 @@ class GuildData:
         self.track_history = []
         self.stay_24_7 = False
         self.auto_disconnect = True
-        self.audio_filter = None
+        self.audio_filter = None  # AUDIO_FILTERS preset name
         self.was_command_leave = False
         self.last_played_title = None
         self.last_played_query = None  # Store the last !play query
         self.queue_backup = None  # For queue loop
         self.autoplay = False  # Smart Autoplay/Auto-DJ Mode
+        self.prefetch_task = None  # Background resolution of the next track
+        self.prefetched = None  # (track, filter, player or None) ready for the next track
+        self.track_finished_at = None  # perf_counter() when the last track's after callback fired
+        self.track_gaps = deque(maxlen=50)  # Seconds of silence between tracks
+        self.breaker = CircuitBreaker(threshold=3, cooldown=5, max_cooldown=60)  # Backs off playback on failing tracks
+        self.alone_since = None  # time.time() when the bot was left alone in its voice channel
+        self.idle_warned_at = None  # Deadline of the last empty-queue warning sent
+        self.playback = None  # PlaybackActor, created on first use
+        self.position_offset = 0  # Seconds into the current track when it was last started, seeked or paused
+        self.position_resumed = None  # time.monotonic() since when it has been playing, None while paused
+        self.position_tempo = 1.0  # AUDIO_FILTER_TEMPO of the filter the current track was started with
+    @property
+    def queue(self):
+        return self._queue
+    @queue.setter
+    def queue(self, queue):
+        # Replacing the queue counts as a change, and so does every later mutation of it
+        queue.on_change = self.mark_dirty
+        self._queue = queue
+        self.mark_dirty()
+    def mark_dirty(self):
+        if self.guild_id is not None:
+            dirty_queues.add(self.guild_id)
+            idle_scheduler.touch(self.guild_id)
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        # Anything that can move this guild's idle deadline
+        if name in IDLE_STATE_FIELDS and self.__dict__.get('guild_id') is not None:
+            idle_scheduler.touch(self.guild_id)
+    def position(self):
+        """Seconds into the current track, not counting time spent paused"""
+        if self.position_resumed is None:
+            return self.position_offset
+        return self.position_offset + (time.monotonic() - self.position_resumed) * self.position_tempo
+    def mark_position(self, offset, paused=False, tempo=None):
+        self.position_offset = offset
+        self.position_resumed = None if paused else time.monotonic()
+        if tempo is not None:
+            self.position_tempo = tempo
     def to_serializable(self):
-        return list(self.queue)
-    def load_queue(self, queue_list):
-        self.queue = deque(queue_list)
+        return encode_tracks(self.queue)
+    def load_queue(self, queue_data):
+        self.queue = TrackQueue(decode_tracks(queue_data))
 import os
 
 
@@ -111,22 +383,15 @@ async def play(ctx, *, query=None):
         data = get_guild_data(ctx.guild.id)
         data.last_interaction = datetime.now()
         data.last_activity = datetime.now()
-        # Download file to temp
-        with tempfile.NamedTemporaryFile(delete=False, suffix="_"+attachment.filename) as tmp:
-            temp_path = tmp.name
-            async with aiohttp.ClientSession() as session:
-                async with session.get(attachment.url) as resp:
-                    tmp.write(await resp.read())
+        # Stream the file to disk (deduplicated by content)
+        try:
+            local_path = await ingest_attachment(attachment)
+        except ValueError as e:
+            await send_error(ctx, str(e))
+            return
         # Add to queue as a local file
-        track = {
-            'title': attachment.filename,
-            'duration': None,
-            'webpage_url': attachment.url,
-            'thumbnail': None,
-            'uploader': ctx.author.display_name,
-            'requester': ctx.author.id,
-            'local_path': temp_path
-        }
+        track = Track(attachment.filename, webpage_url=attachment.url, uploader=ctx.author.display_name,
+                      requester=ctx.author.id, local_path=local_path)
         data.queue.append(track)
         embed = discord.Embed(
             title="✅ Added to Queue (File)",
@@ -135,8 +400,7 @@ async def play(ctx, *, query=None):
         )
         embed.add_field(name="Position in queue", value=f"{len(data.queue)}")
         await ctx.send(embed=embed)
-        if not voice_client.is_playing() and not voice_client.is_paused():
-            await play_next(ctx.guild, ctx)
+        await get_playback(ctx.guild).submit('enqueue', ctx)
         return
 
     # Otherwise, handle as before (search, link, Spotify)
@@ -155,208 +419,58 @@ async def play(ctx, *, query=None):
         is_url = query.startswith(('http://', 'https://', 'www.'))
         # Spotify support
         if is_url and query.startswith('https://open.spotify.com') and spotify:
-            if 'track' in query:
+            kind = spotify_link_type(query)
+            if kind == 'track':
                 # Single Spotify track
-                track_info = spotify.track(query)
-                search_query = f"{track_info['name']} {track_info['artists'][0]['name']} audio"
-                yt_result = await YTDLSource.search(search_query, limit=1)
-                if not yt_result:
+                track_info = await run_spotify(spotify.track, query)
+                track = await resolve_spotify_track(track_info, ctx.author.id)
+                if not track:
                     await send_error(ctx, "No YouTube result found for this Spotify track!")
                     return
-                yt = yt_result[0]
-                track = {
-                    'title': yt['title'],
-                    'duration': yt['duration'],
-                    'webpage_url': yt['webpage_url'],
-                    'thumbnail': yt['thumbnail'],
-                    'uploader': yt['uploader'],
-                    'requester': ctx.author.id
-                }
                 data.queue.append(track)
-                data.last_played_title = yt['title']
+                data.last_played_title = track.title
                 embed = discord.Embed(
                     title="✅ Added to Queue (Spotify)",
-                    description=f"[{track['title']}]({track['webpage_url']})",
+                    description=f"[{track.title}]({track.webpage_url})",
                     color=discord.Color.green()
                 )
-                embed.set_thumbnail(url=track['thumbnail'])
+                embed.set_thumbnail(url=track.thumbnail)
                 embed.add_field(name="Position in queue", value=f"{len(data.queue)}")
                 await ctx.send(embed=embed)
-            elif 'playlist' in query:
-                # Spotify playlist
-                playlist_info = spotify.playlist(query)
-                added = 0
-                for item in playlist_info['tracks']['items']:
-                    t = item['track']
-                    search_query = f"{t['name']} {t['artists'][0]['name']} audio"
-                    yt_result = await YTDLSource.search(search_query, limit=1)
-                    if not yt_result:
-                        continue
-                    yt = yt_result[0]
-                    track = {
-                        'title': yt['title'],
-                        'duration': yt['duration'],
-                        'webpage_url': yt['webpage_url'],
-                        'thumbnail': yt['thumbnail'],
-                        'uploader': yt['uploader'],
-                        'requester': ctx.author.id
-                    }
-                    data.queue.append(track)
-                    added += 1
-                await send_success(ctx, f"Added {added} tracks from Spotify playlist!")
+            elif kind in ('playlist', 'album', 'artist'):
+                # Spotify playlist, album or artist top tracks
+                await enqueue_spotify_collection(ctx, voice_client, query, kind)
             else:
-                await send_error(ctx, "Unsupported Spotify link. Only tracks and playlists are supported.")
+                await send_error(ctx, "Unsupported Spotify link. Only tracks, playlists, albums and artists are supported.")
                 return
         else:
             # YouTube or search
             search_query = query if is_url else f"ytsearch:{query}"
-            info = await YTDLSource.from_url(search_query, loop=asyncio.get_event_loop(), stream=True)
+            with metrics.timer('play_resolve'):
+                info = await YTDLSource.resolve(search_query)
             if not info:
                 await send_error(ctx, "No results found!")
                 return
-            track = {
-                'title': info.title,
-                'duration': info.duration,
-                'webpage_url': info.url,
-                'thumbnail': info.thumbnail,
-                'uploader': info.uploader,
-                'requester': ctx.author.id
-            }
+            track = Track.from_info(info, ctx.author.id)
             data.queue.append(track)
-            data.last_played_title = info.title
+            data.last_played_title = info.get('title')
             if data.loop:
                 data.queue_backup = list(data.queue)
             embed = discord.Embed(
                 title="✅ Added to Queue",
-                description=f"[{track['title']}]({track['webpage_url']})",
+                description=f"[{track.title}]({track.webpage_url})",
                 color=discord.Color.green()
             )
-            embed.set_thumbnail(url=track['thumbnail'])
+            embed.set_thumbnail(url=track.thumbnail)
             embed.add_field(name="Position in queue", value=f"{len(data.queue)}")
             await ctx.send(embed=embed)
         # Start playback if not already playing
-        if not voice_client.is_playing() and not voice_client.is_paused():
-            await play_next(ctx.guild, ctx)
+        with metrics.timer('play_enqueue'):
+            await get_playback(ctx.guild).submit('enqueue', ctx)
     except Exception as e:
         await send_error(ctx, f"❌ Error: {str(e)}")
         print(f"Play command error: {e}")
 
-# --- Final Touch: Play attached files in play_next ---
-import mimetypes
-async def play_next(guild, ctx=None):
-    voice_client = guild.voice_client
-    if not voice_client:
-        return
-    data = get_guild_data(guild.id)
-    # --- QUEUE LOOP POLISH ---
-    if not data.queue:
-        if data.loop:
-            # If looping, restore the backup and continue looping
-            if data.queue_backup and len(data.queue_backup) > 0:
-                data.queue = deque(data.queue_backup)
-                if ctx:
-                    await send_info(ctx, "Looping the queue again!")
-            else:
-                # If no backup, but a song is playing, repeat it
-                if data.now_playing:
-                    data.queue.append(data.now_playing.copy())
-                    if ctx:
-                        await send_info(ctx, "Repeating the current song!")
-                else:
-                    data.empty_since = datetime.now()
-                    data.now_playing = None
-                    if ctx:
-                        await send_info(ctx, "Queue is now empty. I'll stay here for 5 minutes unless new songs are added.")
-                    return
-        elif data.autoplay and data.now_playing:
-            # Smart Autoplay: fetch related tracks and queue one
-            try:
-                search_results = await YTDLSource.search(f"{data.now_playing['title']} related", limit=5)
-                for track in search_results:
-                    if track['id'] != data.now_playing.get('id'):
-                        new_track = {
-                            'title': track['title'],
-                            'duration': track['duration'],
-                            'webpage_url': track['webpage_url'],
-                            'thumbnail': track['thumbnail'],
-                            'uploader': track['uploader'],
-                            'requester': data.now_playing['requester']
-                        }
-                        data.queue.append(new_track)
-                        if ctx:
-                            await send_info(ctx, f"Auto-queued related track: {track['title']}")
-                        break
-                if not data.queue:
-                    if ctx:
-                        await send_info(ctx, "No related tracks found for autoplay.")
-                    data.empty_since = datetime.now()
-                    data.now_playing = None
-                    return
-            except Exception as e:
-                if ctx:
-                    await send_error(ctx, f"Autoplay error: {e}")
-                data.empty_since = datetime.now()
-                data.now_playing = None
-                return
-        else:
-            data.empty_since = datetime.now()
-            data.now_playing = None
-            if ctx:
-                await send_info(ctx, "Queue is now empty. I'll stay here for 5 minutes unless new songs are added.")
-            return
-
-    # Get next song (with loop handling)
-    if data.loop and data.now_playing and not data.queue:
-        # If looping a single song
-        next_track = data.now_playing.copy()
-    else:
-        next_track = data.queue.popleft()
-    data.now_playing = next_track
-    data.empty_since = None
-    data.last_activity = datetime.now()
-    data.current_track_start = datetime.now()
-    # Add to track history (limit to 100 tracks)
-    async with aiosqlite.connect('musicbot.db') as db:
-        await db.execute("INSERT INTO track_history (guild_id, track_data) VALUES (?, ?)",
-                       (guild.id, json.dumps(next_track)))
-        await db.execute("DELETE FROM track_history WHERE id NOT IN (SELECT id FROM track_history WHERE guild_id = ? ORDER BY played_at DESC LIMIT 100)", (guild.id,))
-        await db.commit()
-    try:
-        # If the track is a local file (attachment), play it directly
-        if 'local_path' in next_track and next_track['local_path']:
-            source = discord.FFmpegPCMAudio(next_track['local_path'], **ffmpeg_options)
-            player = discord.PCMVolumeTransformer(source, volume=data.volume)
-        else:
-            player = await YTDLSource.from_url(next_track['webpage_url'], loop=bot.loop, stream=True, filter=data.audio_filter)
-            player.volume = data.volume
-        embed = discord.Embed(
-            title="🎵 Now Playing",
-            description=f"[{next_track['title']}]({next_track['webpage_url']})" if next_track.get('webpage_url') else next_track['title'],
-            color=discord.Color.blue()
-        )
-        if next_track.get('thumbnail'):
-            embed.set_thumbnail(url=next_track['thumbnail'])
-        if next_track.get('duration'):
-            embed.add_field(name="Duration", value=format_duration(next_track['duration']))
-        requester_member = None
-        if isinstance(next_track['requester'], int):
-            requester_member = guild.get_member(next_track['requester'])
-        elif hasattr(next_track['requester'], 'mention'):
-            requester_member = next_track['requester']
-        requester_mention = requester_member.mention if requester_member else str(next_track['requester'])
-        embed.add_field(name="Requested by", value=requester_mention)
-        if data.queue:
-            next_song = data.queue[0]
-            embed.add_field(name="Next Song", value=f"[{next_song['title']}]({next_song['webpage_url']})" if next_song.get('webpage_url') else next_song['title'], inline=False)
-        if data.message_channel:
-            await data.message_channel.send(embed=embed)
-        voice_client.play(player, after=lambda e: asyncio.run_coroutine_threadsafe(play_next(guild), bot.loop))
-    except Exception as e:
-        print(f"Error playing next track: {e}")
-        if data.message_channel:
-            await send_error(data.message_channel, f"Error playing track: {e}")
-        await play_next(guild)
-
 # --- Final Touch: Add slash command support for /play ---
 from discord import app_commands
 
@@ -394,6 +508,7 @@ async def slash_play(interaction: discord.Interaction, query: str = None):
     await play(ctx, query=query)
 
 guild_data = {}  # guild_id: GuildData()
+dirty_queues = set()  # guild ids whose queue changed since the last checkpoint
 
 # Audio filter presets
 AUDIO_FILTERS = {
@@ -403,31 +518,649 @@ AUDIO_FILTERS = {
     '8d': 'apulsator=hz=0.08',
     'clear': None
 }
+# Track seconds per second of playback for presets that change speed (asetrate shifts tempo with pitch)
+AUDIO_FILTER_TEMPO = {
+    'nightcore': 1.25,
+    'vaporwave': 0.8,
+}
 
-# Load queues from DB on startup
-async def load_queues():
-    async with aiosqlite.connect('musicbot.db') as db:
-        cursor = await db.execute("SELECT guild_id, queue_data FROM queues")
-        rows = await cursor.fetchall()
-        for guild_id, queue_data in rows:
-            data = get_guild_data(guild_id)
+# Metrics: per-stage latency histograms and counters, served in Prometheus format and by !stats
+from aiohttp import web
+
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))  # 0: no HTTP endpoint
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_WINDOW = 300  # Seconds of samples behind the rolling percentiles in !stats
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Histogram:
+    """Bucket counts since startup (for Prometheus) plus the most recent samples (for rolling percentiles)"""
+    def __init__(self, buckets=LATENCY_BUCKETS, window=METRICS_WINDOW, max_samples=2048):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last slot: above the largest bucket
+        self.count = 0
+        self.sum = 0.0
+        self.window = window
+        self.recent = deque(maxlen=max_samples)  # (monotonic time, seconds)
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.recent.append((time.monotonic(), seconds))
+
+    def rolling(self):
+        """Sorted samples from the last `window` seconds"""
+        cutoff = time.monotonic() - self.window
+        return sorted(seconds for at, seconds in list(self.recent) if at >= cutoff)
+
+def pick_percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class StageTimer:
+    """with metrics.timer('stage'): ... records the time spent in the block, and failures"""
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+        if exc_type is not None and issubclass(exc_type, Exception):
+            self.metrics.count('stage_errors', stage=self.stage)
+        return False
+
+def _prometheus_labels(pairs):
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}' if pairs else ''
+
+class Metrics:
+    """Stage histograms and event counters recorded in place, plus collectors that read
+    gauges and counters other objects already keep (caches, extraction engine) at scrape time.
+    Histograms and counters are locked: the voice thread records track gaps"""
+    def __init__(self):
+        self.stages = {}  # stage: Histogram
+        self.counters = {}  # (name, ((label, value), ...)): count
+        self.collectors = []  # (name, kind, help, labels, func)
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def timer(self, stage):
+        return StageTimer(self, stage)
+
+    def count(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def rolling(self):
+        """{stage: sorted samples from the last window}"""
+        with self.lock:
+            return {stage: histogram.rolling() for stage, histogram in self.stages.items()}
+
+    def counter_values(self, name):
+        """{((label, value), ...): count} of one counter"""
+        with self.lock:
+            return {labels: value for (counter, labels), value in self.counters.items() if counter == name}
+
+    def collect(self, name, kind, help, func, labels=()):
+        """func returns a number, or {label values tuple: number} when labels are given"""
+        self.collectors.append((name, kind, help, labels, func))
+
+    def read_collectors(self):
+        values = {}
+        for name, kind, help, labels, func in self.collectors:
             try:
-                queue_list = json.loads(queue_data)
-                data.load_queue(queue_list)
-            except Exception:
+                values[name] = func()
+            except Exception as e:
+                print(f"Metrics collector {name} failed: {e}")
+        return values
+
+    def render(self):
+        """Prometheus text exposition format"""
+        lines = ["# HELP pancake_stage_seconds Time spent in each stage of commands and playback",
+                 "# TYPE pancake_stage_seconds histogram"]
+        with self.lock:
+            for stage, histogram in sorted(self.stages.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (None,), histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound is None else f'{bound:g}'
+                    lines.append(f'pancake_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                lines.append(f'pancake_stage_seconds_sum{{stage="{stage}"}} {histogram.sum:.6f}')
+                lines.append(f'pancake_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+            counters = sorted(self.counters.items())
+        for name in sorted({name for (name, _), _ in counters}):
+            lines.append(f"# TYPE pancake_{name}_total counter")
+            for (counter, labels), value in counters:
+                if counter == name:
+                    lines.append(f"pancake_{name}_total{_prometheus_labels(labels)} {value}")
+        collected = self.read_collectors()
+        for name, kind, help, labels, _ in self.collectors:
+            if name not in collected:
+                continue
+            lines += [f"# HELP pancake_{name} {help}", f"# TYPE pancake_{name} {kind}"]
+            value = collected[name]
+            if labels:
+                for label_values, number in value.items():
+                    lines.append(f"pancake_{name}{_prometheus_labels(zip(labels, label_values))} {number}")
+            else:
+                lines.append(f"pancake_{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+# Read when scraped; the objects themselves are created further down
+metrics.collect('uptime_seconds', 'gauge', "Seconds since the bot started", lambda: round(time.monotonic() - metrics.started, 1))
+metrics.collect('voice_clients', 'gauge', "Connected voice clients", lambda: len(bot.voice_clients))
+metrics.collect('guild_states', 'gauge', "Guilds with in-memory state", lambda: len(guild_data))
+metrics.collect('queued_tracks', 'gauge', "Tracks waiting in all queues", lambda: sum(len(data.queue) for data in guild_data.values()))
+metrics.collect('longest_queue', 'gauge', "Length of the longest queue", lambda: max((len(data.queue) for data in guild_data.values()), default=0))
+metrics.collect('extraction_in_flight', 'gauge', "yt-dlp calls running or waiting", lambda: extraction.in_flight)
+metrics.collect('extraction_queue_depth', 'gauge', "yt-dlp calls waiting for a free worker", lambda: extraction.queue_depth)
+metrics.collect('extraction_hung', 'gauge', "Timed-out yt-dlp calls still running on a retired pool", lambda: extraction.hung)
+metrics.collect('extractions_total', 'counter', "Finished yt-dlp calls by outcome",
+                lambda: {('completed',): extraction.completed, ('failed',): extraction.failed,
+                         ('timeout',): extraction.timeouts, ('cancelled',): extraction.cancelled}, labels=('result',))
+metrics.collect('extractions_coalesced_total', 'counter', "Extractions answered by an identical call already in flight",
+                lambda: extraction_flights.coalesced)
+metrics.collect('cache_lookups_total', 'counter', "Stream URL and audio file cache lookups",
+                lambda: {('stream', 'hit'): stream_cache.hits, ('stream', 'miss'): stream_cache.misses,
+                         ('audio', 'hit'): audio_cache.hits, ('audio', 'miss'): audio_cache.misses}, labels=('cache', 'result'))
+metrics.collect('history_pending', 'gauge', "Plays not yet written to track_history", lambda: len(history_writer.pending))
+metrics.collect('dirty_queues', 'gauge', "Queues changed since the last checkpoint", lambda: len(dirty_queues))
+
+async def handle_metrics(request):
+    return web.Response(text=metrics.render(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+metrics_runner = None
+
+async def start_metrics_server():
+    """Serve /metrics on METRICS_HOST:METRICS_PORT, if a port is configured"""
+    global metrics_runner
+    if not METRICS_PORT or metrics_runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    except OSError as e:
+        print(f"Metrics endpoint unavailable: {e}")
+        await runner.cleanup()
+        return
+    metrics_runner = runner
+    print(f"✓ Metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+async def stop_metrics_server():
+    global metrics_runner
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+        metrics_runner = None
+
+# Database layer: one long-lived connection opened in on_ready
+DB_PATH = os.getenv('DB_PATH', 'musicbot.db')
+HISTORY_LIMIT = 100  # Tracks kept in track_history per guild
+GUILD_SETTINGS_COLUMNS = ('volume', 'loop', 'stay_timeout', 'stay_24_7', 'auto_disconnect', 'audio_filter')
+
+def guild_settings_upsert_sql(columns):
+    """UPSERT that only touches the given columns on an existing row. A new row gets NULL in the
+    other columns rather than the schema defaults, so they read back as never set"""
+    unknown = set(columns) - set(GUILD_SETTINGS_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown guild setting: {', '.join(unknown)}")
+    unset = [c for c in GUILD_SETTINGS_COLUMNS if c not in columns]
+    updates = ", ".join(f"{c} = excluded.{c}" for c in columns)
+    return (f"INSERT INTO guild_settings (guild_id, {', '.join(list(columns) + unset)}) "
+            f"VALUES (?{', ?' * len(columns)}{', NULL' * len(unset)}) "
+            f"ON CONFLICT(guild_id) DO UPDATE SET {updates}")
+
+class Database:
+    """Shared aiosqlite connection (WAL mode) with helpers for every table the bot uses"""
+    def __init__(self, path=DB_PATH):
+        self.path = path
+        self.conn = None
+        self.write_lock = asyncio.Lock()  # Keeps multi-statement writes from interleaving on the shared connection
+
+    async def connect(self):
+        if self.conn is not None:
+            return
+        # sqlite3 keeps a per-connection cache of prepared statements keyed by SQL text
+        self.conn = await aiosqlite.connect(self.path, cached_statements=256)
+        await self.conn.execute("PRAGMA journal_mode=WAL")
+        await self.conn.execute("PRAGMA synchronous=NORMAL")
+        await self.conn.execute("PRAGMA busy_timeout=5000")
+        await self.create_tables()
+
+    async def close(self):
+        if self.conn is not None:
+            await self.conn.close()
+            self.conn = None
+
+    async def create_tables(self):
+        await self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS guild_settings
+                (guild_id INTEGER PRIMARY KEY,
+                 volume REAL DEFAULT 1.0,
+                 loop INTEGER DEFAULT 0,
+                 stay_timeout INTEGER DEFAULT 300,
+                 stay_24_7 INTEGER DEFAULT 0,
+                 auto_disconnect INTEGER DEFAULT 1,
+                 audio_filter TEXT DEFAULT NULL);
+            CREATE TABLE IF NOT EXISTS playlists
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 guild_id INTEGER,
+                 user_id INTEGER,
+                 name TEXT,
+                 tracks TEXT,
+                 is_public INTEGER DEFAULT 0);
+            CREATE TABLE IF NOT EXISTS queues
+                (guild_id INTEGER PRIMARY KEY,
+                 queue_data TEXT);
+            CREATE TABLE IF NOT EXISTS track_history
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 guild_id INTEGER,
+                 track_data TEXT,
+                 played_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+            CREATE INDEX IF NOT EXISTS idx_track_history_guild_played
+                ON track_history (guild_id, played_at);
+            CREATE TABLE IF NOT EXISTS spotify_matches
+                (spotify_id TEXT PRIMARY KEY,
+                 isrc TEXT,
+                 video_id TEXT,
+                 title TEXT,
+                 duration INTEGER,
+                 webpage_url TEXT,
+                 thumbnail TEXT,
+                 uploader TEXT,
+                 hits INTEGER DEFAULT 0,
+                 matched_at REAL,
+                 last_used REAL);
+            CREATE INDEX IF NOT EXISTS idx_spotify_matches_isrc
+                ON spotify_matches (isrc);
+        """)
+        await self.conn.commit()
+
+    async def fetchone(self, sql, params=()):
+        with metrics.timer('db_read'):
+            async with self.conn.execute(sql, params) as cursor:
+                return await cursor.fetchone()
+
+    async def fetchall(self, sql, params=()):
+        with metrics.timer('db_read'):
+            async with self.conn.execute(sql, params) as cursor:
+                return await cursor.fetchall()
+
+    async def write(self, sql, params=()):
+        with metrics.timer('db_write'):
+            async with self.write_lock:
+                try:
+                    cursor = await self.conn.execute(sql, params)
+                    await self.conn.commit()
+                except BaseException:
+                    # sqlite3 opened a transaction implicitly; don't let a later commit pick it up
+                    await self.conn.rollback()
+                    raise
+                return cursor.lastrowid
+
+    async def write_many(self, sql, rows):
+        with metrics.timer('db_write'):
+            async with self.write_lock:
+                try:
+                    await self.conn.executemany(sql, rows)
+                    await self.conn.commit()
+                except BaseException:
+                    await self.conn.rollback()
+                    raise
+
+    # guild_settings
+    async def load_guild_settings(self):
+        return await self.fetchall(f"SELECT guild_id, {', '.join(GUILD_SETTINGS_COLUMNS)} FROM guild_settings")
+
+    async def upsert_guild_settings(self, columns, rows):
+        """rows: (guild_id, *values) for the given columns, written in one transaction"""
+        await self.write_many(guild_settings_upsert_sql(columns), rows)
+
+    # playlists
+    async def list_playlists(self, guild_id):
+        return await self.fetchall("SELECT id, name, is_public FROM playlists WHERE guild_id = ? OR is_public = 1 ORDER BY name", (guild_id,))
+
+    async def get_playlist(self, playlist_id, guild_id):
+        """A playlist visible to this guild (its own or a public one)"""
+        return await self.fetchone("SELECT name, tracks FROM playlists WHERE id = ? AND (guild_id = ? OR is_public = 1)", (playlist_id, guild_id))
+
+    async def get_owned_playlist(self, playlist_id, guild_id, user_id):
+        return await self.fetchone("SELECT name FROM playlists WHERE id = ? AND guild_id = ? AND user_id = ?", (playlist_id, guild_id, user_id))
+
+    async def find_playlist(self, guild_id, user_id, name):
+        return await self.fetchone("SELECT id FROM playlists WHERE guild_id = ? AND user_id = ? AND name = ?", (guild_id, user_id, name))
+
+    async def create_playlist(self, guild_id, user_id, name, tracks_json):
+        return await self.write("INSERT INTO playlists (guild_id, user_id, name, tracks) VALUES (?, ?, ?, ?)", (guild_id, user_id, name, tracks_json))
+
+    async def delete_playlist(self, playlist_id):
+        await self.write("DELETE FROM playlists WHERE id = ?", (playlist_id,))
+
+    async def set_playlist_public(self, playlist_id, public):
+        await self.write("UPDATE playlists SET is_public = ? WHERE id = ?", (int(public), playlist_id))
+
+    # queues
+    async def load_queues(self):
+        return await self.fetchall("SELECT guild_id, queue_data FROM queues")
+
+    async def save_queues(self, rows):
+        """rows: iterable of (guild_id, queue_json), written in one transaction"""
+        await self.write_many("INSERT OR REPLACE INTO queues VALUES (?, ?)", rows)
+
+    def save_final(self, queue_rows, history_rows, settings_batches=None):
+        """Blocking write on a separate connection, for signal handlers where the loop may not run again"""
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO queues VALUES (?, ?)", queue_rows)
+                conn.executemany("INSERT INTO track_history (guild_id, track_data, played_at) VALUES (?, ?, ?)", history_rows)
+                for columns, rows in (settings_batches or {}).items():
+                    conn.executemany(guild_settings_upsert_sql(columns), rows)
+        finally:
+            conn.close()
+
+    # track_history
+    async def add_history_batch(self, rows):
+        """rows: list of (guild_id, track_json, played_at). Inserts and trims each guild in one transaction"""
+        with metrics.timer('db_history_batch'):
+            async with self.write_lock:
+                try:
+                    await self.conn.executemany("INSERT INTO track_history (guild_id, track_data, played_at) VALUES (?, ?, ?)", rows)
+                    for guild_id in {row[0] for row in rows}:
+                        # Oldest row we keep, found by walking idx_track_history_guild_played (rowid breaks ties)
+                        async with self.conn.execute("SELECT played_at, id FROM track_history WHERE guild_id = ? ORDER BY played_at DESC, id DESC LIMIT 1 OFFSET ?",
+                                                     (guild_id, HISTORY_LIMIT - 1)) as cursor:
+                            cutoff = await cursor.fetchone()
+                        if cutoff:
+                            await self.conn.execute("DELETE FROM track_history WHERE guild_id = ? AND (played_at < ? OR (played_at = ? AND id < ?))",
+                                                    (guild_id, cutoff[0], cutoff[0], cutoff[1]))
+                    await self.conn.commit()
+                except BaseException:
+                    # Otherwise the rows inserted so far would be committed again with the retried batch
+                    await self.conn.rollback()
+                    raise
+
+    async def get_history(self, guild_id, limit=10, offset=0):
+        return await self.fetchall("SELECT track_data FROM track_history WHERE guild_id = ? ORDER BY played_at DESC, id DESC LIMIT ? OFFSET ?", (guild_id, limit, offset))
+
+    # spotify_matches
+    async def get_spotify_matches(self, spotify_ids, isrcs=()):
+        """Rows matching any of the Spotify ids or ISRCs"""
+        rows = []
+        for column, keys in (('spotify_id', list(spotify_ids)), ('isrc', [i for i in isrcs if i])):
+            # Stay well under SQLite's bound-parameter limit
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows += await self.fetchall(f"SELECT spotify_id, isrc, video_id, title, duration, webpage_url, thumbnail, uploader, matched_at "
+                                            f"FROM spotify_matches WHERE {column} IN ({', '.join('?' * len(chunk))})", chunk)
+        return rows
+
+    async def save_spotify_match(self, spotify_id, isrc, yt):
+        now = time.time()
+        await self.write("INSERT INTO spotify_matches (spotify_id, isrc, video_id, title, duration, webpage_url, thumbnail, uploader, hits, matched_at, last_used) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, ?, ?) ON CONFLICT(spotify_id) DO UPDATE SET "
+                         "isrc = excluded.isrc, video_id = excluded.video_id, title = excluded.title, duration = excluded.duration, "
+                         "webpage_url = excluded.webpage_url, thumbnail = excluded.thumbnail, uploader = excluded.uploader, "
+                         "matched_at = excluded.matched_at, last_used = excluded.last_used",
+                         (spotify_id, isrc, yt.get('id'), yt['title'], yt['duration'], yt['webpage_url'],
+                          yt['thumbnail'], yt['uploader'], now, now))
+
+    async def count_spotify_hits(self, spotify_ids):
+        await self.write_many("UPDATE spotify_matches SET hits = hits + 1, last_used = ? WHERE spotify_id = ?",
+                              [(time.time(), spotify_id) for spotify_id in spotify_ids])
+
+database = Database()
+
+# Track history is written behind playback, in batches
+HISTORY_BATCH_SIZE = 50  # Flush once this many plays are pending
+HISTORY_FLUSH_INTERVAL = 5  # ...or after this many seconds
+HISTORY_MAX_PENDING = 5000  # Rows kept for retrying while writes fail
+
+class HistoryWriter:
+    """Buffers track_history rows so playback never waits on SQLite"""
+    def __init__(self, db, batch_size=HISTORY_BATCH_SIZE, interval=HISTORY_FLUSH_INTERVAL):
+        self.db = db
+        self.batch_size = batch_size
+        self.interval = interval
+        self.pending = []  # (guild_id, track, played_at)
+        self.batch_ready = asyncio.Event()
+        self.task = None
+
+    def add(self, guild_id, track):
+        # Same format as CURRENT_TIMESTAMP so old and new rows sort together
+        played_at = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        self.pending.append((guild_id, track, played_at))
+        if len(self.pending) >= self.batch_size:
+            self.batch_ready.set()
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            # A flush in progress puts its rows back before the final one runs
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.batch_ready.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
                 pass
+            self.batch_ready.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"History flush error, {len(self.pending)} rows kept for the next try: {e}")
+
+    def take_rows(self):
+        pending, self.pending = self.pending, []
+        return [(guild_id, encode_track(track), played_at) for guild_id, track, played_at in pending]
+
+    def put_back(self, pending):
+        """Requeue rows taken for a write that failed; while the DB stays down only the newest are kept"""
+        self.pending = (pending + self.pending)[-HISTORY_MAX_PENDING:]
+
+    async def flush(self):
+        if not self.pending:
+            return
+        pending = self.pending
+        try:
+            await self.db.add_history_batch(self.take_rows())
+        except BaseException:
+            self.put_back(pending)
+            raise
+
+history_writer = HistoryWriter(database)
+
+# Guild settings live in memory; changes are written behind in batches
+SETTINGS_FLUSH_INTERVAL = 2  # Seconds between settings flushes
+
+class SettingsCache:
+    """Every guild_settings row, loaded once at startup. Reads never touch the DB,
+    updates are applied in memory and coalesced per guild into batched UPSERTs"""
+    def __init__(self, db, interval=SETTINGS_FLUSH_INTERVAL):
+        self.db = db
+        self.interval = interval
+        self.rows = {}  # guild_id: {column: value}
+        self.pending = {}  # guild_id: {column: value} not yet written
+        self.task = None
+
+    async def load(self):
+        for guild_id, *values in await self.db.load_guild_settings():
+            self.rows[guild_id] = dict(zip(GUILD_SETTINGS_COLUMNS, values))
+
+    def get(self, guild_id):
+        return self.rows.get(guild_id)
+
+    def update(self, guild_id, **values):
+        unknown = set(values) - set(GUILD_SETTINGS_COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown guild setting: {', '.join(unknown)}")
+        self.rows.setdefault(guild_id, {}).update(values)
+        self.pending.setdefault(guild_id, {}).update(values)
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Settings flush error: {e}")
+
+    def take_batches(self):
+        """{columns: [(guild_id, *values)]}, so guilds that changed the same settings share one statement"""
+        pending, self.pending = self.pending, {}
+        batches = {}
+        for guild_id, values in pending.items():
+            columns = tuple(sorted(values))
+            batches.setdefault(columns, []).append((guild_id, *(values[c] for c in columns)))
+        return batches
+
+    def put_back(self, columns, rows):
+        """Requeue a batch whose write failed, without overwriting values changed since"""
+        for guild_id, *values in rows:
+            pending = self.pending.setdefault(guild_id, {})
+            for column, value in zip(columns, values):
+                pending.setdefault(column, value)
+
+    async def flush(self):
+        if not self.pending:
+            return
+        batches = list(self.take_batches().items())
+        for i, (columns, rows) in enumerate(batches):
+            try:
+                await self.db.upsert_guild_settings(columns, rows)
+            except BaseException:
+                # Keep this batch and the ones not tried yet for the next flush
+                for columns, rows in batches[i:]:
+                    self.put_back(columns, rows)
+                raise
+
+guild_settings = SettingsCache(database)
+
+# Load queues from DB on startup
+async def load_queues():
+    """Restore saved queues. on_ready runs again after every reconnect, so guilds that already have
+    live state keep it instead of being reset to their last checkpoint"""
+    rows = await database.load_queues()
+    for guild_id, queue_data in rows:
+        if guild_id in guild_data:
+            continue
+        data = get_guild_data(guild_id)
+        try:
+            data.load_queue(queue_data)
+        except Exception:
+            pass
+        # A freshly loaded queue already matches the database
+        dirty_queues.discard(guild_id)
+
+# Queue checkpoints: only guilds whose queue changed are written, all in one transaction
+QUEUE_CHECKPOINT_INTERVAL = float(os.getenv('QUEUE_CHECKPOINT_INTERVAL', 10))  # Seconds between checkpoints
+
+def take_dirty_queues():
+    """(guild_id, queue_json) rows for every changed queue, clearing the dirty set"""
+    guild_ids = list(dirty_queues)
+    dirty_queues.clear()
+    return [(guild_id, guild_data[guild_id].to_serializable()) for guild_id in guild_ids if guild_id in guild_data]
 
-# Save queues on shutdown
 async def save_queues():
-    for guild_id, data in guild_data.items():
-        async with aiosqlite.connect('musicbot.db') as db:
-            await db.execute("INSERT OR REPLACE INTO queues VALUES (?, ?)",
-                          (guild_id, json.dumps(data.to_serializable())))
-            await db.commit()
+    rows = take_dirty_queues()
+    if not rows:
+        return
+    try:
+        await database.save_queues(rows)
+    except Exception:
+        # Try again at the next checkpoint
+        dirty_queues.update(guild_id for guild_id, _ in rows)
+        raise
+
+@tasks.loop(seconds=QUEUE_CHECKPOINT_INTERVAL)
+async def checkpoint_queues():
+    try:
+        await save_queues()
+    except Exception as e:
+        print(f"Queue checkpoint error: {e}")
 
-@bot.listen()
-async def on_shutdown():
-    await save_queues()
+def save_state_now():
+    """Write pending queue changes, settings and history synchronously on a separate connection.
+    Only for when the shared connection is closed or the loop can't run; on failure everything stays pending"""
+    history = history_writer.pending
+    queue_rows, history_rows, settings_batches = take_dirty_queues(), history_writer.take_rows(), guild_settings.take_batches()
+    try:
+        database.save_final(queue_rows, history_rows, settings_batches)
+    except Exception as e:
+        print(f"Final save error: {e}")
+        dirty_queues.update(guild_id for guild_id, _ in queue_rows)
+        history_writer.put_back(history)
+        for columns, rows in settings_batches.items():
+            guild_settings.put_back(columns, rows)
+
+def handle_shutdown_signal(signum, frame=None):
+    print(f"Received {signal.Signals(signum).name}, saving queues and history...")
+    try:
+        loop_running = bot.loop.is_running()
+    except AttributeError:
+        loop_running = False
+    if loop_running:
+        # Saved through the shared connection: a second one would wait on its open transaction while blocking the loop
+        asyncio.run_coroutine_threadsafe(shutdown(), bot.loop)
+    else:
+        save_state_now()
+
+async def shutdown():
+    checkpoint_queues.cancel()
+    idle_scheduler.stop()
+    for flush in (save_queues, history_writer.stop, guild_settings.stop):
+        try:
+            await flush()
+        except Exception as e:
+            print(f"Final save error: {e}")
+    await stop_metrics_server()
+    await bot.close()
+    await database.close()
+    if dirty_queues or history_writer.pending or guild_settings.pending:
+        # Whatever the shared connection couldn't write (or changed while closing) gets one more try
+        save_state_now()
+    if http_session is not None:
+        await http_session.close()
+
+def install_shutdown_handlers():
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        try:
+            bot.loop.add_signal_handler(signum, handle_shutdown_signal, signum)
+        except (NotImplementedError, RuntimeError):
+            # Windows: no loop signal handlers
+            signal.signal(signum, handle_shutdown_signal)
 
 # YouTube-DL options
 ytdl_format_options = {
@@ -452,11 +1185,411 @@ ffmpeg_options = {
     'options': '-vn',
 }
 
+# Filters, volume and normalization run inside the FFmpeg process each source already has
+AUDIO_NORMALIZE = os.getenv('AUDIO_NORMALIZE', '0') == '1'  # EBU R128 loudness normalization on every track
+LOUDNORM_FILTER = 'loudnorm=I=-16:TP=-1.5:LRA=11'
+OUTPUT_SAMPLE_RATE = 48000  # What Discord voice expects
+
+def filter_preset_name(value):
+    """AUDIO_FILTERS key for a stored audio_filter (older rows hold the filter string itself), None for no filter"""
+    if value in AUDIO_FILTERS:
+        return value if AUDIO_FILTERS[value] else None
+    for name, chain in AUDIO_FILTERS.items():
+        if chain and chain == value:
+            return name
+    return None
+
+@functools.lru_cache(maxsize=128)
+def audio_filter_chain(preset=None, volume=None, normalize=False):
+    """One -af graph: preset, loudness normalization, volume, then back to Discord's sample rate"""
+    filters = []
+    if AUDIO_FILTERS.get(preset):
+        filters.append(AUDIO_FILTERS[preset])
+    if normalize:
+        filters.append(LOUDNORM_FILTER)
+    if volume is not None and volume != 1:
+        filters.append(f"volume={volume:.3f}")
+    if not filters:
+        return None
+    # asetrate (nightcore, vaporwave) and loudnorm change the rate
+    filters.append(f"aresample={OUTPUT_SAMPLE_RATE}")
+    return ",".join(filters)
+
+@functools.lru_cache(maxsize=128)
+def _ffmpeg_base_options(preset, volume, stream):
+    chain = audio_filter_chain(preset, volume, AUDIO_NORMALIZE)
+    return {
+        'before_options': ffmpeg_options['before_options'] if stream else '',
+        'options': f"{ffmpeg_options['options']} -af {chain}" if chain else ffmpeg_options['options'],
+    }
+
+def ffmpeg_source_options(preset=None, volume=None, *, stream=True, start=0):
+    """FFmpegPCMAudio arguments for one source, built once per (preset, volume, stream).
+    start seeks as an input option, so FFmpeg skips ahead in the stream instead of decoding up to it"""
+    options = _ffmpeg_base_options(preset, volume, stream)
+    if not start:
+        return options
+    return {**options, 'before_options': f"-ss {start:.3f} {options['before_options']}".rstrip()}
+
 ytdl = yt_dlp.YoutubeDL(ytdl_format_options)
 
-class YTDLSource(discord.PCMVolumeTransformer):
-    def __init__(self, source, *, data, volume=0.5, filter=None):
-        super().__init__(source, volume)
+# Search options, flat search skips per-video extraction entirely
+ytdl_search_options = {**ytdl_format_options, 'default_search': 'ytsearch', 'noplaylist': True, 'quiet': True}
+ytdl_flat_search_options = {**ytdl_search_options, 'extract_flat': 'in_playlist'}
+
+# Extraction engine: yt-dlp runs in its own worker pool so it doesn't fight the voice loop for the GIL
+EXTRACTION_MODE = os.getenv('EXTRACTION_MODE', 'process')  # 'process' or 'thread'
+EXTRACTION_WORKERS = int(os.getenv('EXTRACTION_WORKERS', 2))
+EXTRACTION_TIMEOUT = int(os.getenv('EXTRACTION_TIMEOUT', 30))  # Seconds per extract_info call
+
+class CircuitOpenError(Exception):
+    pass
+
+class CircuitBreaker:
+    """Opens after `threshold` failures in a row and rejects calls until a cooldown passes.
+    Each time it re-opens the cooldown doubles, up to max_cooldown."""
+    def __init__(self, threshold, cooldown, max_cooldown):
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.failures = 0
+        self.open_until = 0.0
+        self.trips = 0
+
+    def retry_after(self):
+        return max(0.0, self.open_until - time.monotonic())
+
+    def allow(self):
+        return self.retry_after() == 0
+
+    def record_success(self):
+        self.failures = 0
+        self.cooldown = self.base_cooldown
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.open_until = time.monotonic() + self.cooldown
+            self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+            self.trips += 1
+            self.failures = self.threshold - 1  # Half-open afterwards: one more failure re-opens it
+
+# Errors that are about one video, not about yt-dlp/YouTube being broken
+_TRACK_ERROR_MARKERS = ('unavailable', 'private video', 'removed', 'copyright', 'not available', 'confirm your age', 'members-only')
+
+def is_track_error(error):
+    message = str(error).lower()
+    return any(marker in message for marker in _TRACK_ERROR_MARKERS)
+
+# Negative cache: URLs that failed recently aren't extracted again until the TTL passes
+FAILED_TRACK_TTL = 3600  # Unavailable, private, removed...
+FAILED_TRANSIENT_TTL = 60  # Timeouts, network errors, throttling
+
+class FailureCache:
+    """normalized URL -> (expires_at, reason) for recent extraction failures"""
+    def __init__(self, max_size=4096):
+        self.entries = OrderedDict()
+        self.max_size = max_size
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, reason = entry
+        if expires_at <= time.time():
+            del self.entries[key]
+            return None
+        return reason
+
+    def put(self, key, error):
+        ttl = FAILED_TRACK_TTL if is_track_error(error) else FAILED_TRANSIENT_TTL
+        self.entries[key] = (time.time() + ttl, str(error) or type(error).__name__)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+failed_tracks = FailureCache()
+
+_worker_ytdl = {}  # YoutubeDL instances of this process, keyed by their options
+
+def _extract_info(options, url, download, sanitize):
+    """Runs inside a pool worker. YoutubeDL instances are built once per set of options and reused"""
+    key = json.dumps(options, sort_keys=True, default=str)
+    ytdl_instance = _worker_ytdl.get(key)
+    if ytdl_instance is None:
+        ytdl_instance = _worker_ytdl[key] = yt_dlp.YoutubeDL(options)
+    if not sanitize:
+        return ytdl_instance.extract_info(url, download=download)
+    # Results and errors have to cross the process boundary, so both are reduced to plain data
+    try:
+        info = ytdl_instance.extract_info(url, download=download)
+    except yt_dlp.utils.DownloadError as e:
+        raise yt_dlp.utils.DownloadError(str(e)) from None
+    except Exception as e:
+        raise RuntimeError(f"{type(e).__name__}: {e}") from None
+    return ytdl_instance.sanitize_info(info)
+
+class ExtractionEngine:
+    """Runs ytdl.extract_info in a dedicated process pool (or thread pool) with timeouts and metrics.
+    A worker can't be interrupted, so a call that times out keeps running: the pool it occupies is
+    retired (it finishes in the background) and later calls get a fresh one"""
+    def __init__(self, mode=EXTRACTION_MODE, workers=EXTRACTION_WORKERS, timeout=EXTRACTION_TIMEOUT):
+        self.mode = mode
+        self.workers = workers
+        self.timeout = timeout
+        self.pool = None
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.cancelled = 0
+        self.hung = 0  # Timed-out calls still running on a retired pool
+        self.recycled = 0
+        self.busy_time = 0.0
+        self.breaker = CircuitBreaker(threshold=8, cooldown=15, max_cooldown=300)  # Global, trips on yt-dlp outages
+
+    def _get_pool(self):
+        if self.pool is None and self.mode == 'process':
+            try:
+                # spawn: forking a process that already runs threads and an event loop isn't safe
+                self.pool = concurrent.futures.ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            except (OSError, NotImplementedError) as e:
+                print(f"Process pool unavailable ({e}), extracting in threads instead")
+                self.mode = 'thread'
+        if self.pool is None:
+            self.mode = 'thread'
+            self.pool = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix='extraction')
+        return self.pool
+
+    @property
+    def queue_depth(self):
+        """Calls waiting for a free worker"""
+        return max(0, self.in_flight - self.workers)
+
+    def _abandon(self, pool, future, loop):
+        """A call timed out. If its worker is still busy, retire that pool so it can't fill up with hung calls"""
+        if future.cancel() or future.done():
+            return  # Was still queued, or finished just now
+        self.hung += 1
+        future.add_done_callback(lambda f: self._hung_finished(loop))
+        if self.pool is pool:
+            self.pool = None
+            self.recycled += 1
+            pool.shutdown(wait=False)  # Calls already submitted still run, the workers exit afterwards
+
+    def _hung_finished(self, loop):
+        """Done callback of an abandoned call, runs in a pool thread"""
+        def finished():
+            self.hung -= 1
+        try:
+            loop.call_soon_threadsafe(finished)
+        except RuntimeError:
+            pass  # Loop already closed
+
+    def stats(self):
+        return {
+            'mode': self.mode,
+            'workers': self.workers,
+            'in_flight': self.in_flight,
+            'queue_depth': self.queue_depth,
+            'max_in_flight': self.max_in_flight,
+            'completed': self.completed,
+            'failed': self.failed,
+            'timeouts': self.timeouts,
+            'cancelled': self.cancelled,
+            'hung': self.hung,
+            'pools_recycled': self.recycled,
+            'busy_time': round(self.busy_time, 3),
+            'breaker_open_for': round(self.breaker.retry_after(), 1),
+            'breaker_trips': self.breaker.trips,
+        }
+
+    async def extract(self, url, options=None, *, download=False, timeout=None):
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"YouTube extraction is failing right now, retrying in {int(self.breaker.retry_after()) + 1}s.")
+        options = ytdl_format_options if options is None else options
+        timeout = timeout or self.timeout
+        pool = self._get_pool()
+        loop = asyncio.get_running_loop()
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        start = time.perf_counter()
+        # Cancelling the wrapping future drops calls still waiting in the pool queue
+        future = pool.submit(_extract_info, options, url, download, self.mode == 'process')
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self.breaker.record_failure()
+            self._abandon(pool, future, loop)
+            raise asyncio.TimeoutError(f"Extraction timeout: {url} took longer than {timeout}s")
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        except BrokenProcessPool:
+            # A worker died (OOM, killed), fall back to threads for the rest of the run
+            print("Extraction process pool broke, falling back to threads")
+            self.failed += 1
+            self.breaker.record_failure()
+            if self.pool is pool:
+                self.pool = None
+            self.mode = 'thread'
+            raise
+        except Exception as e:
+            self.failed += 1
+            if is_track_error(e):
+                self.breaker.record_success()  # yt-dlp itself is working
+            else:
+                self.breaker.record_failure()
+            raise
+        else:
+            self.completed += 1
+            self.breaker.record_success()
+            return result
+        finally:
+            self.in_flight -= 1
+            elapsed = time.perf_counter() - start
+            self.busy_time += elapsed
+            metrics.observe('extraction', elapsed)
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+extraction = ExtractionEngine()
+
+_YOUTUBE_HOSTS = {'youtube.com', 'www.youtube.com', 'm.youtube.com', 'music.youtube.com', 'youtu.be'}
+
+def normalize_query(query):
+    """Key that is equal for URLs/searches yt-dlp would resolve to the same thing"""
+    query = query.strip()
+    if not query.startswith(('http://', 'https://', 'www.')):
+        return ' '.join(query.casefold().split())
+    parsed = urlparse(query if '://' in query else f"https://{query}")
+    host = parsed.netloc.lower()
+    if host in _YOUTUBE_HOSTS:
+        params = parse_qs(parsed.query)
+        video_id = parsed.path.strip('/') if host == 'youtu.be' else params.get('v', [None])[0]
+        if video_id:
+            # Tracking params (si, t, feature, ...) don't change the result, a playlist does
+            return f"youtube:{video_id}" + (f"&list={params['list'][0]}" if 'list' in params else '')
+    return urlunparse(parsed._replace(scheme='https', netloc=host, fragment=''))
+
+class SingleFlight:
+    """Coalesces identical concurrent calls: everyone asking for a key while it's in flight shares one result"""
+    def __init__(self):
+        self.calls = {}
+        self.coalesced = 0
+
+    async def do(self, key, func):
+        future = self.calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func())
+            self.calls[key] = future
+            future.add_done_callback(lambda f: self._done(key, f))
+        else:
+            self.coalesced += 1
+        # One caller giving up (cancelled command, replaced prefetch) mustn't cancel it for the others
+        return await asyncio.shield(future)
+
+    def _done(self, key, future):
+        if self.calls.get(key) is future:
+            del self.calls[key]
+        if not future.cancelled():
+            future.exception()  # Mark as retrieved in case every caller was cancelled
+
+extraction_flights = SingleFlight()
+
+# Resolved-stream cache settings
+STREAM_CACHE_SIZE = int(os.getenv('STREAM_CACHE_SIZE', 512))
+STREAM_CACHE_DEFAULT_TTL = int(os.getenv('STREAM_CACHE_DEFAULT_TTL', 1800))  # Used when the stream URL has no expire=
+STREAM_CACHE_EXPIRY_MARGIN = 120  # Don't hand out stream URLs that die within 2 minutes
+STREAM_CACHE_PERSIST = os.getenv('STREAM_CACHE_PERSIST', '0') == '1'
+
+# Only keep the fields we actually use, the full info dict (formats, etc.) is huge
+_STREAM_CACHE_KEYS = ('id', 'title', 'url', 'duration', 'thumbnail', 'uploader', 'webpage_url',
+                      'uploader_url', 'description', 'view_count', 'like_count', 'http_headers',
+                      'acodec', 'abr', 'asr', 'ext', 'extractor')
+
+_EXPIRE_RE = re.compile(r'[?&/]expire[=/](\d+)')
+
+def stream_url_expiry(stream_url):
+    """Return the unix timestamp a stream URL stops working, or None if it doesn't say"""
+    match = _EXPIRE_RE.search(stream_url or '')
+    return int(match.group(1)) if match else None
+
+class StreamCache:
+    """LRU cache of webpage_url -> extracted info dict, expiring with the stream URL"""
+    def __init__(self, max_size=STREAM_CACHE_SIZE, persist=STREAM_CACHE_PERSIST):
+        self.entries = OrderedDict()  # key: (expires_at, info)
+        self.max_size = max_size
+        self.persist = persist
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, info = entry
+        if expires_at - STREAM_CACHE_EXPIRY_MARGIN <= time.time():
+            del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return info
+
+    def put(self, info, *keys):
+        info = {k: info[k] for k in _STREAM_CACHE_KEYS if k in info}
+        expires_at = stream_url_expiry(info.get('url')) or time.time() + STREAM_CACHE_DEFAULT_TTL
+        keys = {k for k in (*keys, info.get('webpage_url')) if k}
+        for key in keys:
+            self.entries[key] = (expires_at, info)
+            self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        if self.persist and keys:
+            asyncio.get_event_loop().create_task(self._save(keys, expires_at, info))
+        return info
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+    async def _save(self, keys, expires_at, info):
+        try:
+            await database.write_many("INSERT OR REPLACE INTO stream_cache (cache_key, expires_at, info) VALUES (?, ?, ?)",
+                                      [(key, expires_at, json.dumps(info)) for key in keys])
+        except Exception as e:
+            print(f"Stream cache save error: {e}")
+
+    async def load(self):
+        """Create the backing table and warm the cache with entries that are still valid"""
+        if not self.persist:
+            return
+        await database.write("""CREATE TABLE IF NOT EXISTS stream_cache
+                                (cache_key TEXT PRIMARY KEY,
+                                 expires_at REAL,
+                                 info TEXT)""")
+        await database.write("DELETE FROM stream_cache WHERE expires_at <= ?", (time.time() + STREAM_CACHE_EXPIRY_MARGIN,))
+        rows = await database.fetchall("SELECT cache_key, expires_at, info FROM stream_cache ORDER BY expires_at DESC LIMIT ?", (self.max_size,))
+        for key, expires_at, info in reversed(rows):
+            self.entries[key] = (expires_at, json.loads(info))
+
+stream_cache = StreamCache()
+
+# Playback mode: 'pcm' decodes in FFmpeg and scales volume/encodes Opus in Python,
+# 'opus' has FFmpeg deliver Opus packets (copied untouched when possible)
+PLAYBACK_MODE = os.getenv('PLAYBACK_MODE', 'pcm')
+OPUS_BITRATE = int(os.getenv('OPUS_BITRATE', 128))  # kbps when FFmpeg has to encode
+
+class TrackInfoMixin:
+    """Track metadata and the first-read hook shared by both source types"""
+    def _set_info(self, data, filter):
         self.data = data
         self.title = data.get('title')
         self.url = data.get('url')
@@ -468,61 +1601,606 @@ class YTDLSource(discord.PCMVolumeTransformer):
         self.description = data.get('description')
         self.views = data.get('view_count')
         self.likes = data.get('like_count')
-        self.filter = filter
+        self.filter = filter  # AUDIO_FILTERS preset name, applied by FFmpeg
+        self.on_first_read = None  # Called with perf_counter() when the first audio frame is read
+
+    def read(self):
+        if self.on_first_read is not None:
+            callback, self.on_first_read = self.on_first_read, None
+            callback(time.perf_counter())
+        return super().read()
+
+class OpusSource(TrackInfoMixin, discord.FFmpegOpusAudio):
+    """FFmpeg outputs Opus packets, so nothing is decoded, scaled or encoded in Python.
+    Volume is part of the filter graph (changing it restarts the source), and an Opus stream
+    with nothing to filter is copied without re-encoding"""
+    def __init__(self, source, *, data, volume=1.0, filter=None, stream=True, start=0):
+        self._set_info(data, filter)
+        self.volume = volume
+        self.passthrough = audio_filter_chain(filter, volume, AUDIO_NORMALIZE) is None and data.get('acodec') == 'opus'
+        # Any codec other than opus/copy makes discord.py encode with libopus
+        super().__init__(source, codec='copy' if self.passthrough else None, bitrate=OPUS_BITRATE,
+                         **ffmpeg_source_options(filter, volume, stream=stream, start=start))
+
+class YTDLSource(TrackInfoMixin, discord.PCMVolumeTransformer):
+    def __init__(self, source, *, data, volume=0.5, filter=None):
+        super().__init__(source, volume)
+        self._set_info(data, filter)
 
     @classmethod
-    async def from_url(cls, url, *, loop=None, stream=False, playlist=False, filter=None):
-        loop = loop or asyncio.get_event_loop()
-        data = await loop.run_in_executor(None, lambda: ytdl.extract_info(url, download=not stream))
+    def create(cls, source, *, data, filter=None, volume=None, stream=True, start=0):
+        """The source for one track in the configured PLAYBACK_MODE"""
+        with metrics.timer('ffmpeg_spawn'):
+            if PLAYBACK_MODE == 'opus':
+                return OpusSource(source, data=data, volume=1.0 if volume is None else volume, filter=filter, stream=stream, start=start)
+            return cls(discord.FFmpegPCMAudio(source, **ffmpeg_source_options(filter, stream=stream, start=start)), data=data, filter=filter)
+
+    @classmethod
+    async def resolve(cls, url, *, loop=None):
+        """Extract info for a single track (no FFmpeg spawned), served from stream_cache when possible"""
+        data = stream_cache.get(url)
+        if data is not None:
+            return data
+        key = normalize_query(url)
+        reason = failed_tracks.get(key)
+        if reason is not None:
+            raise yt_dlp.utils.DownloadError(f"Skipped, this failed recently: {reason}")
+        return await extraction_flights.do(('resolve', key), lambda: cls._resolve_uncached(url, key))
+
+    @classmethod
+    async def _resolve_uncached(cls, url, key):
+        try:
+            data = await extraction.extract(url)
+        except (CircuitOpenError, asyncio.CancelledError):
+            raise
+        except Exception as e:
+            failed_tracks.put(key, e)
+            raise
+        if 'entries' in data:
+            if not data['entries']:
+                return None
+            data = data['entries'][0]
+        return stream_cache.put(data, url)
+
+    @classmethod
+    async def from_url(cls, url, *, loop=None, stream=False, playlist=False, filter=None, start=0, volume=None):
+        if stream and not playlist:
+            data = await cls.resolve(url, loop=loop)
+            if data is None:
+                return None
+            return cls.create(data['url'], data=data, filter=filter, volume=volume, start=start)
+
+        data = await extraction.extract(url, download=not stream)
         
         if 'entries' in data:
             if playlist:
                 entries = data['entries']
-                return [cls(discord.FFmpegPCMAudio(entry['url'], **ffmpeg_options), data=entry, filter=filter) for entry in entries]
+                return [cls.create(entry['url'], data=entry, filter=filter, volume=volume) for entry in entries]
             else:
                 data = data['entries'][0]
         
         filename = data['url'] if stream else ytdl.prepare_filename(data)
-        return cls(discord.FFmpegPCMAudio(filename, **ffmpeg_options), data=data, filter=filter)
+        return cls.create(filename, data=data, filter=filter, volume=volume, stream=stream, start=start)
+
+    @classmethod
+    def from_file(cls, path, *, data, filter=None, start=0, volume=None):
+        """Source for an uploaded file already on disk"""
+        return cls.create(path, data=data, filter=filter, volume=volume, stream=False, start=start)
     
     @classmethod
-    async def search(cls, query, *, loop=None, limit=5):
-        loop = loop or asyncio.get_event_loop()
-        ytdl_search_options = ytdl_format_options.copy()
-        ytdl_search_options['default_search'] = 'ytsearch'
-        ytdl_search_options['noplaylist'] = True
-        ytdl_search_options['quiet'] = True
-        ytdl_search = yt_dlp.YoutubeDL(ytdl_search_options)
-        
+    async def search(cls, query, *, loop=None, limit=5, flat=True):
+        """Search YouTube. flat=True only reads the results page (title, id, duration, uploader),
+        the stream itself is extracted when the track is played."""
         search_query = f"ytsearch{limit}:{query}"
-        data = await loop.run_in_executor(None, lambda: ytdl_search.extract_info(search_query, download=False))
+        return await extraction_flights.do(('search', flat, normalize_query(search_query)), lambda: cls._search_uncached(search_query, flat))
+
+    @classmethod
+    async def _search_uncached(cls, search_query, flat):
+        data = await extraction.extract(search_query, ytdl_flat_search_options if flat else ytdl_search_options)
         
         if 'entries' in data:
-            return data['entries']
+            entries = [entry for entry in data['entries'] if entry]
+            return [flat_search_entry(entry) for entry in entries] if flat else entries
         return []
 
+def flat_search_entry(entry):
+    """Give a flat search result the same fields a full extraction has"""
+    video_id = entry.get('id')
+    thumbnails = entry.get('thumbnails') or []
+    return {
+        'id': video_id,
+        'title': entry.get('title'),
+        'duration': int(entry['duration']) if entry.get('duration') else None,
+        'webpage_url': entry.get('webpage_url') or entry.get('url') or f"https://www.youtube.com/watch?v={video_id}",
+        'thumbnail': entry.get('thumbnail') or (thumbnails[-1].get('url') if thumbnails else f"https://i.ytimg.com/vi/{video_id}/hqdefault.jpg"),
+        'uploader': entry.get('uploader') or entry.get('channel'),
+    }
+
+# Spotify resolution pipeline
+SPOTIFY_RESOLVE_CONCURRENCY = int(os.getenv('SPOTIFY_RESOLVE_CONCURRENCY', 4))  # Parallel YouTube searches per import
+SPOTIFY_PROGRESS_INTERVAL = 3  # Seconds between progress message edits
+SPOTIFY_MATCH_MAX_AGE = int(os.getenv('SPOTIFY_MATCH_MAX_AGE', 30 * 86400))  # Re-search stored matches older than this
+
+def spotify_link_type(url):
+    """'track', 'playlist', 'album', 'artist' or None for an open.spotify.com link"""
+    match = re.search(r'open\.spotify\.com/(?:intl-[\w-]+/)?(track|playlist|album|artist)/', url)
+    return match.group(1) if match else None
+
+async def run_spotify(func, *args, **kwargs):
+    """spotipy is blocking, keep its HTTP calls off the event loop"""
+    return await asyncio.get_event_loop().run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+async def spotify_track_pages(url, kind):
+    """Yield (collection name, list of Spotify track objects) page by page, following every next link"""
+    if kind == 'playlist':
+        name = (await run_spotify(spotify.playlist, url, fields='name'))['name']
+        page = await run_spotify(spotify.playlist_items, url, additional_types=('track',))
+    elif kind == 'album':
+        name = (await run_spotify(spotify.album, url))['name']
+        page = await run_spotify(spotify.album_tracks, url)
+    else:
+        artist = await run_spotify(spotify.artist, url)
+        tracks = (await run_spotify(spotify.artist_top_tracks, url))['tracks']
+        yield f"{artist['name']} top tracks", tracks
+        return
+    while page:
+        # Playlist items wrap the track, album items are the track
+        tracks = [item.get('track', item) if kind == 'playlist' else item for item in page['items']]
+        yield name, [t for t in tracks if t and t.get('type', 'track') == 'track' and not t.get('is_local')]
+        page = await run_spotify(spotify.next, page) if page.get('next') else None
+
+def spotify_isrc(track_info):
+    return (track_info.get('external_ids') or {}).get('isrc')
+
+async def lookup_spotify_matches(track_infos):
+    """Stored YouTube matches for these Spotify tracks, {spotify_id: match}. Stale matches are left out"""
+    ids = {t['id'] for t in track_infos if t.get('id')}
+    isrcs = {spotify_isrc(t) for t in track_infos} - {None}
+    if not ids:
+        return {}
+    try:
+        rows = await database.get_spotify_matches(ids, isrcs)
+    except Exception as e:
+        print(f"Spotify match lookup error: {e}")
+        return {}
+    fresh_after = time.time() - SPOTIFY_MATCH_MAX_AGE
+    by_id, by_isrc = {}, {}
+    for spotify_id, isrc, video_id, title, duration, webpage_url, thumbnail, uploader, matched_at in rows:
+        if matched_at < fresh_after:
+            continue
+        match = {'title': title, 'duration': duration, 'webpage_url': webpage_url, 'thumbnail': thumbnail, 'uploader': uploader, 'id': video_id}
+        by_id[spotify_id] = match
+        if isrc:
+            by_isrc[isrc] = match
+    matches = {}
+    for t in track_infos:
+        # Same recording under another Spotify id (single vs album release) shares the ISRC
+        match = by_id.get(t.get('id')) or by_isrc.get(spotify_isrc(t))
+        if match:
+            matches[t['id']] = match
+    hits = [spotify_id for spotify_id in matches if spotify_id in by_id]
+    if hits:
+        await database.count_spotify_hits(hits)
+    return matches
+
+async def resolve_spotify_track(track_info, requester, matches=None):
+    """Find the YouTube match for a Spotify track and build the queue entry, None if nothing matched"""
+    if matches is None:
+        matches = await lookup_spotify_matches([track_info])
+    match = matches.get(track_info.get('id'))
+    if match:
+        return Track(**match, requester=requester)
+    search_query = f"{track_info['name']} {track_info['artists'][0]['name']} audio"
+    yt_result = await YTDLSource.search(search_query, limit=1)
+    if not yt_result:
+        return None
+    yt = yt_result[0]
+    if track_info.get('id'):
+        try:
+            await database.save_spotify_match(track_info['id'], spotify_isrc(track_info), yt)
+        except Exception as e:
+            print(f"Spotify match save error: {e}")
+    return Track.from_info(yt, requester)
+
+async def enqueue_spotify_collection(ctx, voice_client, url, kind):
+    """Resolve every track of a Spotify playlist/album/artist concurrently and queue them in order.
+
+    Playback starts as soon as the first track is matched, progress is shown by editing one message.
+    """
+    data = get_guild_data(ctx.guild.id)
+    semaphore = asyncio.Semaphore(SPOTIFY_RESOLVE_CONCURRENCY)
+    pending = asyncio.Queue()  # Resolution tasks in playlist order, None when every page is read
+    name = f"Spotify {kind}"
+    total = added = missed = 0
+
+    async def resolve(track_info):
+        async with semaphore:
+            try:
+                return await resolve_spotify_track(track_info, ctx.author.id, matches={})
+            except Exception as e:
+                print(f"Spotify resolve error for {track_info.get('name')}: {e}")
+                return None
+
+    async def produce():
+        nonlocal name, total
+        try:
+            async for page_name, tracks in spotify_track_pages(url, kind):
+                name = page_name
+                matches = await lookup_spotify_matches(tracks)
+                for track_info in tracks:
+                    total += 1
+                    match = matches.get(track_info.get('id'))
+                    if match:
+                        # Already matched before, no search needed
+                        done = asyncio.get_event_loop().create_future()
+                        done.set_result(Track(**match, requester=ctx.author.id))
+                        pending.put_nowait(done)
+                    else:
+                        pending.put_nowait(asyncio.create_task(resolve(track_info)))
+        finally:
+            pending.put_nowait(None)
+
+    progress = await ctx.send(f"ℹ️ Resolving tracks from {kind}...")
+    last_edit = time.monotonic()
+    producer = asyncio.create_task(produce())
+    try:
+        while (task := await pending.get()) is not None:
+            track = await task
+            if track is None:
+                missed += 1
+                continue
+            data.queue.append(track)
+            added += 1
+            if added == 1 or data.queue[0] is track:
+                # Starts playback, or prefetches this track when the queue had run dry behind the playing one
+                await get_playback(ctx.guild).submit('enqueue', ctx)
+            if progress and time.monotonic() - last_edit >= SPOTIFY_PROGRESS_INTERVAL:
+                last_edit = time.monotonic()
+                await progress.edit(content=f"ℹ️ Resolving **{name}**: {added + missed}/{total} tracks ({added} queued)...")
+        await producer  # Surface paging errors
+    finally:
+        if not producer.done():
+            producer.cancel()
+        while not pending.empty():
+            task = pending.get_nowait()
+            if task is not None:
+                task.cancel()
+    summary = f"✅ Added {added} tracks from **{name}**!" + (f" ({missed} had no YouTube match)" if missed else "")
+    if progress:
+        await progress.edit(content=summary)
+    else:
+        await ctx.send(summary)
+
 # Helper functions
 def get_guild_data(guild_id):
     if guild_id not in guild_data:
-        guild_data[guild_id] = GuildData()
-        
-        # Load guild settings from DB
-        async def load_settings():
-            async with aiosqlite.connect('musicbot.db') as db:
-                cursor = await db.execute("SELECT volume, loop, stay_timeout, stay_24_7, auto_disconnect, audio_filter FROM guild_settings WHERE guild_id = ?", (guild_id,))
-                row = await cursor.fetchone()
-                if row:
-                    data = guild_data[guild_id]
-                    data.volume = row[0]
-                    data.loop = bool(row[1])
-                    data.stay_24_7 = bool(row[3])
-                    data.auto_disconnect = bool(row[4])
-                    data.audio_filter = row[5]
-                    # Load autoplay from DB if you add it later
-        asyncio.create_task(load_settings())
-        
+        data = guild_data[guild_id] = GuildData(guild_id)
+        # Settings were preloaded in on_ready, so they are in place before the first command runs
+        # NULL columns were never set for this guild and keep the GuildData defaults
+        settings = {column: value for column, value in (guild_settings.get(guild_id) or {}).items() if value is not None}
+        if settings:
+            data.volume = settings.get('volume', data.volume)
+            data.loop = bool(settings.get('loop', data.loop))
+            data.stay_24_7 = bool(settings.get('stay_24_7', data.stay_24_7))
+            data.auto_disconnect = bool(settings.get('auto_disconnect', data.auto_disconnect))
+            data.audio_filter = filter_preset_name(settings.get('audio_filter'))
     return guild_data[guild_id]
 
+# Prefetching: resolve the next track while the current one plays
+PREFETCH_FFMPEG = os.getenv('PREFETCH_FFMPEG', '0') == '1'  # Also pre-spawn the FFmpeg source
+PREFETCH_FFMPEG_LEAD = 10  # Seconds before the current track ends to spawn FFmpeg
+
+def prefetch_target(data):
+    """The track playback will pick next, if it can be known in advance"""
+    if data.queue:
+        return data.queue[0]
+    if data.loop and data.queue_backup:
+        return data.queue_backup[0]
+    return None
+
+def invalidate_prefetch(data):
+    if data.prefetch_task and not data.prefetch_task.done():
+        data.prefetch_task.cancel()
+    data.prefetch_task = None
+    if data.prefetched:
+        player = data.prefetched[2]
+        if player is not None:
+            player.cleanup()
+        data.prefetched = None
+
+def schedule_prefetch(guild):
+    """(Re)start prefetching whatever comes next, call after anything that changes the queue order"""
+    data = get_guild_data(guild.id)
+    track = prefetch_target(data)
+    if data.prefetched and data.prefetched[0] is track and data.prefetched[1] == data.audio_filter:
+        return
+    if data.prefetch_task and not data.prefetch_task.done() and getattr(data.prefetch_task, 'track', None) is track:
+        return
+    invalidate_prefetch(data)
+    if track is None or track.local_path or not track.webpage_url:
+        return
+    data.prefetch_task = asyncio.create_task(_prefetch(data, track, data.audio_filter))
+    data.prefetch_task.track = track
+
+async def _prefetch(data, track, audio_filter):
+    try:
+        await YTDLSource.resolve(track.webpage_url)
+        if data.prefetch_task is not asyncio.current_task():
+            return  # Playback got here first, the stream is cached for it anyway
+        data.prefetched = (track, audio_filter, None)
+        if PREFETCH_FFMPEG:
+            if data.now_playing and data.now_playing.duration:
+                remaining = (data.now_playing.duration - data.position()) / data.position_tempo
+                await asyncio.sleep(max(0, remaining - PREFETCH_FFMPEG_LEAD))
+            player = await YTDLSource.from_url(track.webpage_url, stream=True, filter=audio_filter, volume=data.volume)
+            data.prefetched = (track, audio_filter, player)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"Prefetch error: {e}")
+
+def take_prefetched(data, track):
+    """Return the pre-spawned player for track if it's still valid, stream URLs are already warm in stream_cache"""
+    prefetched, data.prefetched = data.prefetched, None
+    task, data.prefetch_task = data.prefetch_task, None
+    if task and not task.done() and prefetched is not None:
+        task.cancel()  # Only waiting to pre-spawn FFmpeg, a task still resolving is left to fill the cache
+    if not prefetched:
+        return None
+    prefetched_track, audio_filter, player = prefetched
+    if prefetched_track is track and audio_filter == data.audio_filter and player is not None \
+            and not (isinstance(player, OpusSource) and player.volume != data.volume):
+        return player
+    if player is not None:
+        player.cleanup()
+    return None
+
+# Shared HTTP session for everything the bot downloads itself
+http_session = None
+
+def get_http_session():
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession()
+    return http_session
+
+DOWNLOAD_CHUNK = 256 * 1024
+
+async def stream_to_file(url, path, *, limit, headers=None, hasher=None):
+    """Download url into path chunk by chunk, file writes run off the event loop. Returns the size.
+    Raises ValueError past limit bytes; hasher (hashlib object) is fed every chunk"""
+    size = 0
+    async with get_http_session().get(url, headers=headers or {}) as resp:
+        resp.raise_for_status()
+        if resp.content_length and resp.content_length > limit:
+            raise ValueError("file too large")
+        file = await asyncio.to_thread(open, path, 'wb')
+        try:
+            async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK):
+                size += len(chunk)
+                if size > limit:
+                    raise ValueError("file too large")
+                if hasher is not None:
+                    hasher.update(chunk)
+                await asyncio.to_thread(file.write, chunk)
+        finally:
+            await asyncio.to_thread(file.close)
+    return size
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+# Uploaded audio files: stored once per content hash, deleted once nothing refers to them
+UPLOAD_DIR = os.getenv('UPLOAD_DIR') or os.path.join(tempfile.gettempdir(), 'pancake-uploads')
+UPLOAD_MAX_MB = int(os.getenv('UPLOAD_MAX_MB', 50))
+UPLOAD_RETENTION = 3600  # Seconds an unreferenced upload is kept, so recent history can still be replayed
+
+def is_upload_path(path):
+    """True for files inside UPLOAD_DIR, the only local files the bot plays"""
+    upload_dir = os.path.realpath(UPLOAD_DIR)
+    try:
+        return os.path.commonpath([upload_dir, os.path.realpath(path)]) == upload_dir
+    except ValueError:
+        return False  # Different drives on Windows
+
+async def ingest_attachment(attachment):
+    """Path of the attachment's content on disk. Re-uploads of the same file reuse the existing copy"""
+    limit = UPLOAD_MAX_MB * 1024 * 1024
+    if attachment.size and attachment.size > limit:
+        raise ValueError(f"Files can be at most {UPLOAD_MAX_MB} MB!")
+    await asyncio.to_thread(os.makedirs, UPLOAD_DIR, exist_ok=True)
+    hasher = hashlib.sha256()
+    part = os.path.join(UPLOAD_DIR, f"{attachment.id}.part")
+    try:
+        await stream_to_file(attachment.url, part, limit=limit, hasher=hasher)
+    except BaseException as e:
+        remove_file(part)
+        if isinstance(e, ValueError):
+            raise ValueError(f"Files can be at most {UPLOAD_MAX_MB} MB!") from e
+        raise
+    path = os.path.join(UPLOAD_DIR, hasher.hexdigest()[:32] + os.path.splitext(attachment.filename)[1].lower())
+    if os.path.exists(path):
+        await asyncio.to_thread(remove_file, part)
+        await asyncio.to_thread(os.utime, path)
+    else:
+        await asyncio.to_thread(os.replace, part, path)
+    return path
+
+def referenced_uploads():
+    """local_path of every track still queued, playing or kept for a queue loop"""
+    paths = set()
+    for data in guild_data.values():
+        tracks = [*data.queue, *(data.queue_backup or ()), data.now_playing]
+        paths.update(track.local_path for track in tracks if track is not None and track.local_path)
+    return paths
+
+def _remove_stale_uploads(keep, now):
+    removed = 0
+    for entry in os.scandir(UPLOAD_DIR):
+        if entry.path not in keep and now - entry.stat().st_mtime > UPLOAD_RETENTION:
+            remove_file(entry.path)
+            removed += 1
+    return removed
+
+@tasks.loop(minutes=10)
+async def cleanup_uploads():
+    if not os.path.isdir(UPLOAD_DIR):
+        return
+    try:
+        await asyncio.to_thread(_remove_stale_uploads, referenced_uploads(), time.time())
+    except Exception as e:
+        print(f"Upload cleanup error: {e}")
+
+# On-disk audio cache: tracks played repeatedly are kept as files, so replays and loops skip YouTube
+AUDIO_CACHE_DIR = os.getenv('AUDIO_CACHE_DIR')  # Unset: cache disabled
+AUDIO_CACHE_SIZE_MB = int(os.getenv('AUDIO_CACHE_SIZE_MB', 1024))
+AUDIO_CACHE_MIN_PLAYS = int(os.getenv('AUDIO_CACHE_MIN_PLAYS', 2))  # Plays before a track is worth caching
+AUDIO_CACHE_MAX_TRACK_SECONDS = 1800  # Longer tracks (and streams) are never cached
+AUDIO_CACHE_FILLS = 2  # Concurrent background downloads
+# {video_id}-{format_key}.{acodec}: codecs like mp4a.40.2 contain dots, so split on the 8-hex-digit format key
+_AUDIO_CACHE_NAME_RE = re.compile(r'^(.+)-([0-9a-f]{8})\.(.+)$')
+
+class AudioCache:
+    """Byte-bounded LRU of downloaded audio, keyed by video id and yt-dlp format.
+    Files are written to a .part file and renamed, so a crash never leaves a truncated entry"""
+    def __init__(self, directory=AUDIO_CACHE_DIR, max_bytes=AUDIO_CACHE_SIZE_MB * 1024 * 1024, min_plays=AUDIO_CACHE_MIN_PLAYS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+        self.entries = OrderedDict()  # (video_id, format_key): (path, size, acodec), least recently used first
+        self.total_bytes = 0
+        self.plays = OrderedDict()  # (video_id, format_key): plays so far, bounded
+        self.filling = set()
+        self.fill_slots = asyncio.Semaphore(AUDIO_CACHE_FILLS)
+        self.hits = 0
+        self.misses = 0
+        self.fills = 0
+        self.evictions = 0
+        self.loaded = False
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    @staticmethod
+    def format_key(fmt):
+        return hashlib.sha1(fmt.encode()).hexdigest()[:8]
+
+    def key(self, track):
+        return (track.id, self.format_key(ytdl_format_options['format']))
+
+    def _path(self, key, acodec):
+        video_id, format_key = key
+        return os.path.join(self.directory, f"{video_id}-{format_key}.{acodec or 'audio'}")
+
+    def _scan(self):
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.part'):
+                os.remove(entry.path)  # Interrupted fill
+                continue
+            match = _AUDIO_CACHE_NAME_RE.match(entry.name)
+            if match:
+                video_id, format_key, acodec = match.groups()
+                stat = entry.stat()
+                found.append((stat.st_mtime, (video_id, format_key), entry.path, stat.st_size, None if acodec == 'audio' else acodec))
+        return sorted(found)
+
+    async def load(self):
+        """Index the cache directory. Once per process: on_ready runs again after every reconnect,
+        and a rescan would count entries twice and delete the .part files of running fills"""
+        if not self.enabled or self.loaded:
+            return
+        self.loaded = True
+        for _, key, path, size, acodec in await asyncio.to_thread(self._scan):
+            self.entries[key] = (path, size, acodec)
+            self.total_bytes += size
+        self._evict()
+
+    def get(self, track):
+        """(path, acodec) of the cached audio for track, or None"""
+        if not self.enabled or not track.id:
+            return None
+        key = self.key(track)
+        entry = self.entries.get(key)
+        if entry is None or not os.path.exists(entry[0]):
+            if entry is not None:
+                self._drop(key)
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        try:
+            os.utime(entry[0])  # Keeps LRU order across restarts
+        except OSError:
+            pass
+        return entry[0], entry[2]
+
+    def note_play(self, track):
+        """Count a play, and start a background fill once the track has been played often enough"""
+        if not self.enabled or not track.id or track.local_path or not track.webpage_url:
+            return
+        if not track.duration or track.duration > AUDIO_CACHE_MAX_TRACK_SECONDS:
+            return
+        key = self.key(track)
+        if key in self.entries or key in self.filling:
+            return
+        plays = self.plays.pop(key, 0) + 1
+        self.plays[key] = plays
+        if len(self.plays) > 10000:
+            self.plays.popitem(last=False)
+        if plays >= self.min_plays:
+            self.filling.add(key)
+            asyncio.create_task(self._fill(key, track.webpage_url))
+
+    async def _fill(self, key, url):
+        part = None
+        try:
+            async with self.fill_slots:
+                info = await YTDLSource.resolve(url)
+                if not info or not info.get('url'):
+                    return
+                acodec = info.get('acodec') if info.get('acodec') not in (None, 'none') else None
+                path = self._path(key, acodec)
+                part = path + '.part'
+                size = await stream_to_file(info['url'], part, limit=self.max_bytes // 4, headers=info.get('http_headers'))
+                await asyncio.to_thread(os.replace, part, path)
+                part = None
+                self.entries[key] = (path, size, acodec)
+                self.total_bytes += size
+                self.fills += 1
+                self.plays.pop(key, None)
+                self._evict()
+        except Exception as e:
+            print(f"Audio cache fill error: {e}")
+        finally:
+            self.filling.discard(key)
+            if part:
+                remove_file(part)
+
+    def _drop(self, key):
+        path, size, _ = self.entries.pop(key)
+        self.total_bytes -= size
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            self._drop(next(iter(self.entries)))
+            self.evictions += 1
+
+    def stats(self):
+        return {'entries': len(self.entries), 'bytes': self.total_bytes, 'hits': self.hits, 'misses': self.misses,
+                'fills': self.fills, 'evictions': self.evictions}
+
+audio_cache = AudioCache()
+
 async def connect_to_voice(ctx):
     voice_state = ctx.author.voice
     if not voice_state or not voice_state.channel:
@@ -531,10 +2209,12 @@ async def connect_to_voice(ctx):
     
     voice_client = ctx.guild.voice_client
     if not voice_client:
-        voice_client = await voice_state.channel.connect(self_deaf=True)
+        with metrics.timer('voice_connect'):
+            voice_client = await voice_state.channel.connect(self_deaf=True)
     elif voice_client.channel != voice_state.channel:
-        await voice_client.move_to(voice_state.channel)
-        await voice_client.guild.change_voice_state(channel=voice_state.channel, self_deaf=True)
+        with metrics.timer('voice_connect'):
+            await voice_client.move_to(voice_state.channel)
+            await voice_client.guild.change_voice_state(channel=voice_state.channel, self_deaf=True)
     
     data = get_guild_data(ctx.guild.id)
     data.message_channel = ctx.channel
@@ -543,23 +2223,44 @@ async def connect_to_voice(ctx):
     
     return voice_client
 
-async def check_empty_voice(guild):
+# Idle disconnects: one deadline per connected guild, kept in a heap, instead of sweeping every guild
+IDLE_TIMEOUT = 300  # Seconds without activity (and nothing playing)
+EMPTY_QUEUE_TIMEOUT = 300  # Seconds with an empty queue
+EMPTY_CHANNEL_TIMEOUT = 15  # Seconds alone in the voice channel
+EMPTY_QUEUE_WARNINGS = (60, 45, 30, 15)  # Seconds left when a warning is sent
+
+def idle_deadline(guild, now):
+    """(when, action) of the next idle event for this guild, or None while there is nothing to wait for"""
     voice_client = guild.voice_client
     if not voice_client:
-        return
-    
+        return None
     data = get_guild_data(guild.id)
-    
-    # Skip checks if in 24/7 mode
-    if data.stay_24_7:
-        return
-    
-    # Skip checks if auto-disconnect is disabled
-    if not data.auto_disconnect:
-        return
-    
-    # Smarter disconnect: disconnect if no activity for 5 minutes
-    if (datetime.now() - data.last_activity).total_seconds() > 300:
+    if data.stay_24_7 or not data.auto_disconnect:
+        return None
+    events = []
+    if not voice_client.is_playing():
+        events.append((data.last_activity.timestamp() + IDLE_TIMEOUT, 'inactive'))
+    if len(voice_client.channel.members) <= 1:
+        if data.alone_since is None:
+            data.alone_since = now
+        events.append((data.alone_since + EMPTY_CHANNEL_TIMEOUT, 'empty_channel'))
+    else:
+        data.alone_since = None
+    if not data.queue and data.empty_since:
+        end = data.empty_since.timestamp() + EMPTY_QUEUE_TIMEOUT
+        events.append((end, 'empty_queue'))
+        for remaining in EMPTY_QUEUE_WARNINGS:
+            when = end - remaining
+            # Warnings that were due while we weren't watching are skipped
+            if when >= now - 1 and (data.idle_warned_at is None or when > data.idle_warned_at):
+                events.append((when, remaining))
+                break
+    return min(events, key=lambda event: event[0]) if events else None
+
+async def run_idle_action(guild, when, action):
+    voice_client = guild.voice_client
+    data = get_guild_data(guild.id)
+    if action == 'inactive':
         embed = discord.Embed(
             title="👋 Auto-disconnect",
             description="Taking a little break! I'll disconnect to save resources.",
@@ -580,146 +2281,380 @@ async def check_empty_voice(guild):
         await voice_client.disconnect()
         if data.message_channel:
             await data.message_channel.send(embed=embed)
-        return
-
-    # Check if voice channel is empty (except bot)
-    if len(voice_client.channel.members) <= 1:
+    elif action == 'empty_channel':
         await voice_client.disconnect()
         if data.message_channel:
             await send_info(data.message_channel, "Disconnected from voice channel because it's empty.")
-        return
-    
-    # Check if queue is empty for too long
-    if not data.queue and data.empty_since:
-        time_elapsed = (datetime.now() - data.empty_since).total_seconds()
-        remaining_time = 300 - time_elapsed  # 5 minutes timeout
-        
-        if remaining_time <= 0:
-            await voice_client.disconnect()
-            if data.message_channel:
-                await send_info(data.message_channel, "Disconnected due to inactivity (empty queue for 5 minutes).")
-        elif remaining_time <= 60 and int(remaining_time) % 15 == 0:  # Notify every 15 seconds in last minute
-            if data.message_channel:
-                await send_info(data.message_channel, f"I will disconnect in {int(remaining_time)} seconds if the queue remains empty...")
+    elif action == 'empty_queue':
+        await voice_client.disconnect()
+        if data.message_channel:
+            await send_info(data.message_channel, "Disconnected due to inactivity (empty queue for 5 minutes).")
+    else:
+        data.idle_warned_at = when
+        if data.message_channel:
+            await send_info(data.message_channel, f"I will disconnect in {action} seconds if the queue remains empty...")
+
+class IdleScheduler:
+    """Keeps the next idle deadline of each connected guild. Guild state changes only mark the guild
+    as touched; its deadline is recomputed once, the next time the scheduler runs"""
+    def __init__(self):
+        self.heap = []  # (when, seq, guild_id); entries whose seq is no longer current are skipped
+        self.current = {}  # guild_id: seq of its live heap entry
+        self.seq = 0
+        self.touched = set()
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def touch(self, guild_id):
+        self.touched.add(guild_id)
+        self.wakeup.set()
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def _reschedule(self, guild_id, now):
+        guild = bot.get_guild(guild_id)
+        event = idle_deadline(guild, now) if guild else None
+        if event is None:
+            self.current.pop(guild_id, None)
+            return
+        self.seq += 1
+        self.current[guild_id] = self.seq
+        heapq.heappush(self.heap, (event[0], self.seq, guild_id))
+
+    async def _fire(self, guild_id, now):
+        guild = bot.get_guild(guild_id)
+        event = idle_deadline(guild, now) if guild else None
+        if event and event[0] <= now + 0.5:
+            await run_idle_action(guild, *event)
+
+    async def _run(self):
+        while True:
+            self.wakeup.clear()
+            now = time.time()
+            touched, self.touched = self.touched, set()
+            for guild_id in touched:
+                self._reschedule(guild_id, now)
+            while self.heap and self.current.get(self.heap[0][2]) != self.heap[0][1]:
+                heapq.heappop(self.heap)
+            if self.heap and self.heap[0][0] <= now:
+                _, _, guild_id = heapq.heappop(self.heap)
+                del self.current[guild_id]
+                try:
+                    await self._fire(guild_id, now)
+                except Exception as e:
+                    print(f"Idle check error: {e}")
+                self._reschedule(guild_id, time.time())
+                continue
+            timeout = self.heap[0][0] - now if self.heap else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+idle_scheduler = IdleScheduler()
 
 async def send_error(ctx, message):
     """Send an error message with consistent formatting"""
-    if isinstance(ctx, discord.Interaction):
-        if ctx.response.is_done():
-            await ctx.followup.send(f"❌ {message}", ephemeral=True)
+    with metrics.timer('message_send'):
+        if isinstance(ctx, discord.Interaction):
+            if ctx.response.is_done():
+                await ctx.followup.send(f"❌ {message}", ephemeral=True)
+            else:
+                await ctx.response.send_message(f"❌ {message}", ephemeral=True)
         else:
-            await ctx.response.send_message(f"❌ {message}", ephemeral=True)
-    else:
-        await ctx.send(f"❌ {message}")
+            await ctx.send(f"❌ {message}")
 
 async def send_info(ctx, message):
     """Send an info message with consistent formatting"""
-    if isinstance(ctx, discord.Interaction):
-        if ctx.response.is_done():
-            await ctx.followup.send(f"ℹ️ {message}", ephemeral=False)
+    with metrics.timer('message_send'):
+        if isinstance(ctx, discord.Interaction):
+            if ctx.response.is_done():
+                await ctx.followup.send(f"ℹ️ {message}", ephemeral=False)
+            else:
+                await ctx.response.send_message(f"ℹ️ {message}", ephemeral=False)
         else:
-            await ctx.response.send_message(f"ℹ️ {message}", ephemeral=False)
-    else:
-        await ctx.send(f"ℹ️ {message}")
+            await ctx.send(f"ℹ️ {message}")
 
 async def send_success(ctx, message):
     """Send a success message with consistent formatting"""
-    if isinstance(ctx, discord.Interaction):
-        if ctx.response.is_done():
-            await ctx.followup.send(f"✅ {message}", ephemeral=False)
+    with metrics.timer('message_send'):
+        if isinstance(ctx, discord.Interaction):
+            if ctx.response.is_done():
+                await ctx.followup.send(f"✅ {message}", ephemeral=False)
+            else:
+                await ctx.response.send_message(f"✅ {message}", ephemeral=False)
         else:
-            await ctx.response.send_message(f"✅ {message}", ephemeral=False)
-    else:
-        await ctx.send(f"✅ {message}")
-
-async def play_next(guild, ctx=None):
-    voice_client = guild.voice_client
-    if not voice_client:
-        return
-    data = get_guild_data(guild.id)
-    # --- QUEUE LOOP FIX ---
-    if not data.queue:
-        if data.loop and data.queue_backup and len(data.queue_backup) > 0:
-            data.queue = deque(data.queue_backup)
-        elif data.autoplay and data.now_playing:
-            # Smart Autoplay: fetch related tracks and queue one
+            await ctx.send(f"✅ {message}")
+
+PLAY_NEXT_MAX_FAILURES = 10  # Tracks that may fail in a row before playback gives up
+
+def record_track_gap(data, seconds):
+    """Runs in the voice thread when the next track's first frame is read"""
+    data.track_gaps.append(seconds)
+    metrics.observe('track_gap', seconds)
+
+class PlaybackActor:
+    """Owns playback for one guild. Commands and the voice thread's "source finished" event go
+    through one inbox and are handled in order by a single task, so two advances can never race"""
+    IDLE = 'idle'  # Nothing is playing
+    STARTING = 'starting'  # Resolving and starting the next track
+    PLAYING = 'playing'  # A source is playing (or paused)
+
+    def __init__(self, guild):
+        self.guild = guild
+        self.state = self.IDLE
+        self.inbox = deque()  # (command, args, future)
+        self.task = None
+        self.source_id = 0  # Changes whenever a source starts or is stopped, so stale finished events are ignored
+
+    def submit(self, command, *args):
+        """Queue a command (enqueue, skip, stop, restart), the returned future resolves once it was handled"""
+        future = asyncio.get_running_loop().create_future()
+        self.inbox.append((command, args, future))
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        return future
+
+    def interrupted(self):
+        """A command that takes over is waiting. Finished events of sources we stopped don't count"""
+        return any(command != 'finished' or args[0] == self.source_id for command, args, _ in self.inbox)
+
+    async def _run(self):
+        # The task only lives while there are commands to handle
+        while self.inbox:
+            command, args, future = self.inbox.popleft()
             try:
-                search_results = await YTDLSource.search(f"{data.now_playing['title']} related", limit=5)
-                for track in search_results:
-                    if track['id'] != data.now_playing.get('id'):
-                        new_track = {
-                            'title': track['title'],
-                            'duration': track['duration'],
-                            'webpage_url': track['webpage_url'],
-                            'thumbnail': track['thumbnail'],
-                            'uploader': track['uploader'],
-                            'requester': data.now_playing['requester']
-                        }
-                        data.queue.append(new_track)
+                await getattr(self, f'_on_{command}')(*args)
+            except Exception as e:
+                print(f"Playback error ({command}): {e}")
+            finally:
+                if not future.done():
+                    future.set_result(None)
+
+    def _source_finished(self, source_id):
+        """after callback for voice_client.play, runs in the voice thread"""
+        bot.loop.call_soon_threadsafe(self.submit, 'finished', source_id, time.perf_counter())
+
+    def _source_active(self):
+        voice_client = self.guild.voice_client
+        return bool(voice_client and (voice_client.is_playing() or voice_client.is_paused()))
+
+    def _stop_source(self):
+        self.source_id += 1
+        if self._source_active():
+            self.guild.voice_client.stop()
+
+    async def _on_enqueue(self, ctx=None):
+        if self.state == self.PLAYING and not self._source_active():
+            self.state = self.IDLE  # The voice client went away under us
+        if self.state == self.IDLE:
+            await self._advance(ctx)
+        else:
+            schedule_prefetch(self.guild)
+
+    async def _on_finished(self, source_id, finished_at):
+        if source_id != self.source_id or self.state != self.PLAYING:
+            return  # A source we stopped ourselves
+        get_guild_data(self.guild.id).track_finished_at = finished_at
+        await self._advance()
+
+    async def _on_skip(self, ctx=None):
+        if self.state != self.PLAYING:
+            return
+        self._stop_source()
+        await self._advance(ctx)
+
+    async def _on_stop(self):
+        self._stop_source()
+        self.state = self.IDLE
+
+    async def _on_restart(self, ctx=None, start=None):
+        """Restart the current track at start seconds (default: where it is now), e.g. after a filter change
+        or to seek. The stream URL comes from stream_cache, so this only respawns FFmpeg"""
+        data = get_guild_data(self.guild.id)
+        if self.state != self.PLAYING or not data.now_playing:
+            return
+        if start is None:
+            start = data.position()
+        paused = self.guild.voice_client.is_paused()
+        self._stop_source()
+        try:
+            await self._start(data.now_playing, start)
+            if paused:
+                self.guild.voice_client.pause()
+                data.mark_position(start, paused=True)
+            schedule_prefetch(self.guild)
+        except Exception as e:
+            print(f"Error restarting track: {e}")
+            if data.message_channel:
+                await send_error(data.message_channel, f"Error playing track: {e}")
+            await self._advance(ctx)
+
+    async def _wait(self, seconds):
+        """Back off, but give up as soon as another command arrives. True if interrupted"""
+        deadline = time.monotonic() + seconds
+        while not self.interrupted() and time.monotonic() < deadline:
+            await asyncio.sleep(min(0.25, deadline - time.monotonic()))
+        return self.interrupted()
+
+    async def _start(self, track, start=None):
+        """Start track from the beginning, or at start seconds when restarting the current track"""
+        data = get_guild_data(self.guild.id)
+        player = take_prefetched(data, track) if start is None else None
+        cached = audio_cache.get(track) if player is None else None
+        if cached:
+            path, acodec = cached
+            player = YTDLSource.from_file(path, data={**track.to_dict(), 'acodec': acodec}, filter=data.audio_filter, start=start or 0, volume=data.volume)
+        elif player is None and track.local_path and is_upload_path(track.local_path) and os.path.exists(track.local_path):
+            player = YTDLSource.from_file(track.local_path, data=track.to_dict(), filter=data.audio_filter, start=start or 0, volume=data.volume)
+        elif player is None:
+            player = await YTDLSource.from_url(track.webpage_url, loop=bot.loop, stream=True, filter=data.audio_filter, start=start or 0, volume=data.volume)
+        player.volume = data.volume
+        finished_at, data.track_finished_at = data.track_finished_at, None
+        if finished_at is not None:
+            player.on_first_read = lambda now: record_track_gap(data, now - finished_at)
+        voice_client = self.guild.voice_client
+        if not voice_client:
+            player.cleanup()
+            raise RuntimeError("Not connected to voice")
+        self.source_id += 1
+        source_id = self.source_id
+        voice_client.play(player, after=lambda e: self._source_finished(source_id))
+        data.mark_position(start or 0, tempo=AUDIO_FILTER_TEMPO.get(data.audio_filter, 1.0))
+        self.state = self.PLAYING
+
+    async def _advance(self, ctx=None):
+        """Pick the next track and start it, moving past tracks that fail"""
+        guild = self.guild
+        self.state = self.IDLE
+        if not guild.voice_client:
+            return
+        data = get_guild_data(guild.id)
+        self.state = self.STARTING
+        failures = 0
+        while True:
+            # --- QUEUE LOOP FIX ---
+            if not data.queue:
+                if data.loop and data.queue_backup and len(data.queue_backup) > 0:
+                    data.queue = TrackQueue(data.queue_backup)
+                elif data.autoplay and data.now_playing:
+                    # Smart Autoplay: fetch related tracks and queue one
+                    try:
+                        search_results = await YTDLSource.search(f"{data.now_playing.title} related", limit=5)
+                        for result in search_results:
+                            if result['id'] != data.now_playing.id:
+                                data.queue.append(Track.from_info(result, data.now_playing.requester))
+                                if ctx:
+                                    await send_info(ctx, f"Auto-queued related track: {result['title']}")
+                                break
+                        if not data.queue:
+                            if ctx:
+                                await send_info(ctx, "No related tracks found for autoplay.")
+                            data.empty_since = datetime.now()
+                            data.now_playing = None
+                            self.state = self.IDLE
+                            return
+                    except Exception as e:
                         if ctx:
-                            await send_info(ctx, f"Auto-queued related track: {track['title']}")
-                        break
-                if not data.queue:
-                    if ctx:
-                        await send_info(ctx, "No related tracks found for autoplay.")
+                            await send_error(ctx, f"Autoplay error: {e}")
+                        data.empty_since = datetime.now()
+                        data.now_playing = None
+                        self.state = self.IDLE
+                        return
+                else:
                     data.empty_since = datetime.now()
                     data.now_playing = None
+                    self.state = self.IDLE
+                    if ctx:
+                        await send_info(ctx, "Queue is now empty. I'll stay here for 5 minutes unless new songs are added.")
                     return
+            # Get next song (with loop handling)
+            if data.loop and data.now_playing and not data.queue:
+                next_track = data.now_playing
+            else:
+                next_track = data.queue.popleft()
+            data.now_playing = next_track
+            data.empty_since = None
+            data.last_activity = datetime.now()
+            data.current_track_start = datetime.now()
+            retry_after = 0
+            try:
+                with metrics.timer('track_start'):
+                    await self._start(next_track)
+            except CircuitOpenError as e:
+                # Extraction as a whole is backing off, the track itself is fine: keep it and wait
+                data.queue.appendleft(next_track)
+                data.now_playing = None
+                if data.message_channel:
+                    await send_error(data.message_channel, str(e))
+                retry_after = extraction.breaker.retry_after()
             except Exception as e:
-                if ctx:
-                    await send_error(ctx, f"Autoplay error: {e}")
-                data.empty_since = datetime.now()
+                print(f"Error playing next track: {e}")
+                data.breaker.record_failure()
+                failures += 1
+                if data.message_channel:
+                    await send_error(data.message_channel, f"Error playing track: {e}")
+                if failures >= PLAY_NEXT_MAX_FAILURES:
+                    data.now_playing = None
+                    data.empty_since = datetime.now()
+                    self.state = self.IDLE
+                    if data.message_channel:
+                        await send_error(data.message_channel, f"{failures} tracks in a row failed to play, stopping here. Use !play or !skip to continue.")
+                    return
+                retry_after = data.breaker.retry_after()
+            else:
+                data.breaker.record_success()
+                break
+            if not guild.voice_client or (retry_after and await self._wait(retry_after)):
+                # Disconnected, or a newer command (stop, enqueue...) takes over from here
                 data.now_playing = None
+                self.state = self.IDLE
                 return
-        else:
-            data.empty_since = datetime.now()
-            data.now_playing = None
-            if ctx:
-                await send_info(ctx, "Queue is now empty. I'll stay here for 5 minutes unless new songs are added.")
-            return
-    # Get next song (with loop handling)
-    if data.loop and data.now_playing and not data.queue:
-        next_track = data.now_playing
-    else:
-        next_track = data.queue.popleft()
-    data.now_playing = next_track
-    data.empty_since = None
-    data.last_activity = datetime.now()
-    data.current_track_start = datetime.now()
-    # Add to track history (limit to 100 tracks)
-    async with aiosqlite.connect('musicbot.db') as db:
-        await db.execute("INSERT INTO track_history (guild_id, track_data) VALUES (?, ?)",
-                       (guild.id, json.dumps(next_track)))
-        await db.execute("DELETE FROM track_history WHERE id NOT IN (SELECT id FROM track_history WHERE guild_id = ? ORDER BY played_at DESC LIMIT 100)", (guild.id,))
-        await db.commit()
-    try:
-        embed = discord.Embed(
-            title="🎵 Now Playing",
-            description=f"[{next_track['title']}]({next_track['webpage_url']})",
-            color=discord.Color.blue()
-        )
-        embed.set_thumbnail(url=next_track['thumbnail'])
-        embed.add_field(name="Duration", value=format_duration(next_track['duration']))
-        requester_member = None
-        if isinstance(next_track['requester'], int):
-            requester_member = guild.get_member(next_track['requester'])
-        elif hasattr(next_track['requester'], 'mention'):
-            requester_member = next_track['requester']
-        requester_mention = requester_member.mention if requester_member else str(next_track['requester'])
-        embed.add_field(name="Requested by", value=requester_mention)
-        if data.queue:
-            next_song = data.queue[0]
-            embed.add_field(name="Next Song", value=f"[{next_song['title']}]({next_song['webpage_url']})", inline=False)
-        if data.message_channel:
-            await data.message_channel.send(embed=embed)
-        player = await YTDLSource.from_url(next_track['webpage_url'], loop=bot.loop, stream=True, filter=data.audio_filter)
-        player.volume = data.volume
-        voice_client.play(player, after=lambda e: asyncio.run_coroutine_threadsafe(play_next(guild), bot.loop))
-    except Exception as e:
-        print(f"Error playing next track: {e}")
-        if data.message_channel:
-            await send_error(data.message_channel, f"Error playing track: {e}")
-        await play_next(guild)
+        # Add to track history (written in the background, trimmed to HISTORY_LIMIT)
+        history_writer.add(guild.id, next_track)
+        audio_cache.note_play(next_track)
+        schedule_prefetch(guild)
+        await self._announce(next_track)
+
+    async def _announce(self, next_track):
+        guild = self.guild
+        data = get_guild_data(guild.id)
+        try:
+            embed = discord.Embed(
+                title="🎵 Now Playing",
+                description=f"[{next_track.title}]({next_track.webpage_url})",
+                color=discord.Color.blue()
+            )
+            embed.set_thumbnail(url=next_track.thumbnail)
+            embed.add_field(name="Duration", value=format_duration(next_track.duration))
+            requester_member = None
+            if isinstance(next_track.requester, int):
+                requester_member = guild.get_member(next_track.requester)
+            elif hasattr(next_track.requester, 'mention'):
+                requester_member = next_track.requester
+            requester_mention = requester_member.mention if requester_member else str(next_track.requester)
+            embed.add_field(name="Requested by", value=requester_mention)
+            if data.queue:
+                next_song = data.queue[0]
+                embed.add_field(name="Next Song", value=f"[{next_song.title}]({next_song.webpage_url})", inline=False)
+            if data.message_channel:
+                with metrics.timer('message_send'):
+                    await data.message_channel.send(embed=embed)
+        except Exception as e:
+            print(f"Error sending now playing message: {e}")
+
+def get_playback(guild):
+    data = get_guild_data(guild.id)
+    if data.playback is None:
+        data.playback = PlaybackActor(guild)
+    return data.playback
 
 def format_duration(seconds):
     if not seconds:
@@ -730,12 +2665,194 @@ def format_duration(seconds):
         return f"{hours}:{minutes:02d}:{seconds:02d}"
     return f"{minutes}:{seconds:02d}"
 
+# Command profiling (opt-in): wall time, event-loop blocking and sampled cProfile traces per command
+COMMAND_PROFILING = os.getenv('COMMAND_PROFILING', '0') == '1'
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0.1))  # Fraction of invocations run under cProfile
+SLOW_COMMAND_MS = float(os.getenv('SLOW_COMMAND_MS', 3000))  # Invocations slower than this are stored...
+SLOW_BLOCK_MS = float(os.getenv('SLOW_BLOCK_MS', 100))  # ...and so are those that held the loop this long in one go
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_LOG_MAX_BYTES = 2 * 1024 * 1024  # Small enough that every file fits in one Discord upload
+PROFILE_LOG_BACKUPS = 3
+PROFILE_TOP_FUNCTIONS = 25  # Lines of cProfile output kept per stored invocation
+SLOW_COMMANDS_SCANNED = 500  # Newest stored invocations summarized by !slowcommands
+
+def _suspended_at(coro):
+    """The await chain a coroutine is suspended in, outermost first, e.g. play (Pancake.py:412) → sleep (tasks.py:649)"""
+    chain = []
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+        if frame is None:
+            break
+        chain.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+    return " → ".join(chain) or None
+
+class TimedCoroutine:
+    """Drives a coroutine step by step, timing each step it runs on the event loop. A long step is
+    a blocking call; where the coroutine suspended right after it points at the culprit.
+    With a profile, cProfile is only enabled while this coroutine's own steps run"""
+    def __init__(self, coro, profile=None):
+        self.coro = coro
+        self.profile = profile
+        self.busy = 0.0
+        self.longest = 0.0
+        self.longest_ended_at = None
+        self.steps = 0
+
+    def _step(self, method, arg):
+        start = time.perf_counter()
+        if self.profile is not None:
+            try:
+                self.profile.enable()
+            except ValueError:
+                self.profile = None  # Another profiler is active
+        try:
+            return method(arg)
+        finally:
+            if self.profile is not None:
+                self.profile.disable()
+            elapsed = time.perf_counter() - start
+            self.busy += elapsed
+            self.steps += 1
+            if elapsed > self.longest:
+                self.longest = elapsed
+                self.longest_ended_at = _suspended_at(self.coro) or "return"
+
+    def __await__(self):
+        method, arg = self.coro.send, None
+        while True:
+            try:
+                yielded = self._step(method, arg)
+            except StopIteration as e:
+                return e.value
+            try:
+                arg = yield yielded
+                method = self.coro.send
+            except GeneratorExit:
+                self.coro.close()
+                raise
+            except BaseException as e:
+                method, arg = self.coro.throw, e
+
+class SlowCommandLog:
+    """Slow invocations as JSON lines, rotated to .1 ... .backups once the file passes max_bytes"""
+    def __init__(self, directory=PROFILE_DIR, max_bytes=PROFILE_LOG_MAX_BYTES, backups=PROFILE_LOG_BACKUPS):
+        self.directory = directory
+        self.path = os.path.join(directory, 'slow_commands.jsonl')
+        self.max_bytes = max_bytes
+        self.backups = max(1, backups)
+        self.lock = threading.Lock()  # Appends run in executor threads
+
+    def append(self, record):
+        line = json.dumps(record, separators=(',', ':'), default=str) + '\n'
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            try:
+                size = os.path.getsize(self.path)
+            except OSError:
+                size = 0
+            if size and size + len(line) > self.max_bytes:
+                self._rotate()
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+    def files(self):
+        """Existing log files, newest first"""
+        paths = [self.path] + [f"{self.path}.{i}" for i in range(1, self.backups + 1)]
+        return [path for path in paths if os.path.exists(path)]
+
+    def recent(self, count):
+        """The newest `count` records, newest first"""
+        records = []
+        with self.lock:
+            for path in self.files():
+                with open(path, encoding='utf-8') as f:
+                    lines = f.readlines()
+                for line in reversed(lines):
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        continue
+                    if len(records) >= count:
+                        return records
+        return records
+
+class CommandProfiler:
+    """Used by command_error_handler. Off unless COMMAND_PROFILING=1, then every invocation is timed
+    and a PROFILE_SAMPLE_RATE share also runs under cProfile"""
+    def __init__(self, enabled=COMMAND_PROFILING, sample_rate=PROFILE_SAMPLE_RATE,
+                 slow_ms=SLOW_COMMAND_MS, block_ms=SLOW_BLOCK_MS, log=None):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_ms / 1000
+        self.block_seconds = block_ms / 1000
+        self.log = log or SlowCommandLog()
+        self.invocations = 0
+        self.stored = 0
+
+    async def run(self, func, args, kwargs):
+        if not self.enabled:
+            return await func(*args, **kwargs)
+        profile = cProfile.Profile() if random.random() < self.sample_rate else None
+        timed = TimedCoroutine(func(*args, **kwargs), profile)
+        started_at = time.time()
+        start = time.perf_counter()
+        error = None
+        try:
+            return await timed
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self.invocations += 1
+            wall = time.perf_counter() - start
+            if wall >= self.slow_seconds or timed.longest >= self.block_seconds:
+                self._store(func, args, started_at, wall, timed, error)
+
+    def _store(self, func, args, started_at, wall, timed, error):
+        ctx = args[0] if args else None
+        command = getattr(ctx, 'command', None)
+        message = getattr(ctx, 'message', None)
+        guild = getattr(ctx, 'guild', None)
+        record = {
+            'command': command.qualified_name if command else func.__name__,
+            'message': (getattr(message, 'content', None) or '')[:200],
+            'guild_id': guild.id if guild else None,
+            'started_at': datetime.fromtimestamp(started_at, timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
+            'wall_ms': round(wall * 1000, 1),
+            'loop_busy_ms': round(timed.busy * 1000, 1),
+            'longest_block_ms': round(timed.longest * 1000, 1),
+            'longest_block_ended_at': timed.longest_ended_at,
+            'steps': timed.steps,
+            'error': f"{type(error).__name__}: {error}" if error is not None else None,
+        }
+        if timed.profile is not None:
+            buffer = io.StringIO()
+            pstats.Stats(timed.profile, stream=buffer).sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+            record['profile'] = buffer.getvalue()
+        self.stored += 1
+        asyncio.get_running_loop().run_in_executor(None, self._append, record)
+
+    def _append(self, record):
+        try:
+            self.log.append(record)
+        except OSError as e:
+            print(f"Could not store slow command profile: {e}")
+
+command_profiler = CommandProfiler()
+
 # Error handling decorator with custom error messages
 def command_error_handler(func):
     @functools.wraps(func)
     async def wrapper(*args, **kwargs):
         try:
-            return await func(*args, **kwargs)
+            return await command_profiler.run(func, args, kwargs)
         except discord.errors.NotFound:
             ctx = args[0] if args else None
             if ctx:
@@ -801,8 +2918,8 @@ async def queue(ctx, page: int = 1):
     )
     
     if data.now_playing:
-        elapsed = (datetime.now() - data.current_track_start).total_seconds()
-        duration = data.now_playing['duration'] or 0
+        elapsed = data.position()
+        duration = data.now_playing.duration or 0
         progress = min(elapsed / duration if duration > 0 else 0, 1)
         progress_bar = "".join(['▰' if i/20 <= progress else '▱' for i in range(20)])
         current_time = format_duration(int(elapsed))
@@ -810,19 +2927,19 @@ async def queue(ctx, page: int = 1):
         
         embed.add_field(
             name="🎵 Now Playing",
-            value=f"[{data.now_playing['title']}]({data.now_playing['webpage_url']})\n{progress_bar}\n`{current_time} / {total_time}`",
+            value=f"[{data.now_playing.title}]({data.now_playing.webpage_url})\n{progress_bar}\n`{current_time} / {total_time}`",
             inline=False
         )
-        if data.now_playing.get('thumbnail'):
-            embed.set_thumbnail(url=data.now_playing['thumbnail'])
+        if data.now_playing.thumbnail:
+            embed.set_thumbnail(url=data.now_playing.thumbnail)
     
     if data.queue:
         start = (page - 1) * items_per_page
         end = start + items_per_page
         queue_lines = []
-        for i, track in enumerate(list(data.queue)[start:end], start=start+1):
-            duration = format_duration(track['duration'])
-            queue_lines.append(f"`{i}.` [{track['title']}]({track['webpage_url']}) - {duration}")
+        for i, track in enumerate(data.queue.page(start, end), start=start+1):
+            duration = format_duration(track.duration)
+            queue_lines.append(f"`{i}.` [{track.title}]({track.webpage_url}) - {duration}")
 
         # Split lines into chunks of <=1024 chars for embed field value
         chunk = ""
@@ -844,8 +2961,7 @@ async def queue(ctx, page: int = 1):
                 inline=False
             )
     
-    total_duration = sum(t['duration'] for t in data.queue if t['duration'])
-    embed.set_footer(text=f"Total: {len(data.queue)} tracks | {format_duration(total_duration)}")
+    embed.set_footer(text=f"Total: {len(data.queue)} tracks | {format_duration(data.queue.total_duration)}")
     
     await ctx.send(embed=embed)
 
@@ -863,9 +2979,8 @@ async def skip(ctx):
     data.last_interaction = datetime.now()
     data.last_activity = datetime.now()
     
-    voice_client.stop()
     await send_success(ctx, "Skipped the current song!")
-    await play_next(ctx.guild, ctx)
+    await get_playback(ctx.guild).submit('skip', ctx)
 
 @bot.command(name="pause")
 @command_error_handler
@@ -882,6 +2997,7 @@ async def pause(ctx):
     data.last_activity = datetime.now()
     
     voice_client.pause()
+    data.mark_position(data.position(), paused=True)
     await send_success(ctx, "Paused the music!")
 
 @bot.command(name="resume", aliases=['r'])
@@ -899,8 +3015,39 @@ async def resume(ctx):
     data.last_activity = datetime.now()
     
     voice_client.resume()
+    data.mark_position(data.position())
     await send_success(ctx, "Resumed the music!")
 
+def parse_timestamp(value):
+    """Seconds from '90', '1:30' or '1:02:30'"""
+    seconds = 0
+    for part in value.split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+@bot.command(name="seek")
+@command_error_handler
+async def seek(ctx, position: str):
+    """Jump to a position in the current song (seconds, mm:ss or hh:mm:ss)"""
+    voice_client = ctx.guild.voice_client
+    data = get_guild_data(ctx.guild.id)
+    if not voice_client or not (voice_client.is_playing() or voice_client.is_paused()) or not data.now_playing:
+        await send_error(ctx, "Nothing is playing right now!")
+        return
+    try:
+        target = parse_timestamp(position)
+    except ValueError:
+        await send_error(ctx, "Use seconds, mm:ss or hh:mm:ss, e.g. `!seek 1:30`")
+        return
+    duration = data.now_playing.duration
+    if target < 0 or (duration and target >= duration):
+        await send_error(ctx, f"Position must be between 0:00 and {format_duration(duration)}!")
+        return
+    data.last_interaction = datetime.now()
+    data.last_activity = datetime.now()
+    await get_playback(ctx.guild).submit('restart', ctx, target)
+    await send_success(ctx, f"Jumped to {format_duration(int(target))}!")
+
 @bot.command(name="stop")
 @command_error_handler
 async def stop(ctx):
@@ -917,12 +3064,13 @@ async def stop(ctx):
     data.queue_backup = None
     data.loop = False
     data.now_playing = None
+    invalidate_prefetch(data)
     data.empty_since = datetime.now()
     data.last_interaction = datetime.now()
     data.last_activity = datetime.now()
     
     # Stop the voice client
-    voice_client.stop()
+    await get_playback(ctx.guild).submit('stop')
     
     # Disconnect from voice channel
     await voice_client.disconnect()
@@ -943,6 +3091,8 @@ async def leave(ctx):
 
 @bot.event
 async def on_voice_state_update(member, before, after):
+    if member.guild.voice_client or member.id == bot.user.id:
+        idle_scheduler.touch(member.guild.id)
     if member.id == bot.user.id and before.channel and not after.channel:
         guild_id = before.channel.guild.id
         if guild_id in guild_data:
@@ -953,6 +3103,8 @@ async def on_voice_state_update(member, before, after):
                 data.queue.clear()
                 data.now_playing = None
                 data.empty_since = None
+                invalidate_prefetch(data)
+                get_playback(before.channel.guild).submit('stop')
                 channel = data.message_channel or before.channel.guild.system_channel
                 if channel:
                     try:
@@ -960,6 +3112,15 @@ async def on_voice_state_update(member, before, after):
                     except Exception:
                         pass
 
+@bot.event
+async def on_guild_remove(guild):
+    """Forget in-memory state of guilds the bot was removed from"""
+    data = guild_data.pop(guild.id, None)
+    if data is not None:
+        invalidate_prefetch(data)
+    dirty_queues.discard(guild.id)
+    idle_scheduler.touch(guild.id)
+
 @bot.command(name="volume", aliases=['v'])
 @command_error_handler
 async def volume(ctx, volume: int = None):
@@ -983,7 +3144,11 @@ async def volume(ctx, volume: int = None):
     data.last_interaction = datetime.now()
     data.last_activity = datetime.now()
     
-    if voice_client.source:
+    guild_settings.update(ctx.guild.id, volume=data.volume)
+    if isinstance(voice_client.source, OpusSource):
+        # Volume is baked into the FFmpeg graph: respawn FFmpeg at the current position
+        await get_playback(ctx.guild).submit('restart', ctx)
+    elif voice_client.source:
         voice_client.source.volume = data.volume
     
     await send_success(ctx, f"Volume set to {volume}%")
@@ -1022,21 +3187,21 @@ async def nowplaying(ctx):
     
     embed = discord.Embed(
         title="🎵 Now Playing",
-        description=f"[{data.now_playing['title']}]({data.now_playing['webpage_url']})",
+        description=f"[{data.now_playing.title}]({data.now_playing.webpage_url})",
         color=discord.Color.blue()
     )
-    embed.set_thumbnail(url=data.now_playing['thumbnail'])
-    embed.add_field(name="Duration", value=format_duration(data.now_playing['duration']))
+    embed.set_thumbnail(url=data.now_playing.thumbnail)
+    embed.add_field(name="Duration", value=format_duration(data.now_playing.duration))
     
-    requester_member = ctx.guild.get_member(data.now_playing['requester']) if isinstance(data.now_playing['requester'], int) else None
-    requester_mention = requester_member.mention if requester_member else str(data.now_playing['requester'])
+    requester_member = ctx.guild.get_member(data.now_playing.requester) if isinstance(data.now_playing.requester, int) else None
+    requester_mention = requester_member.mention if requester_member else str(data.now_playing.requester)
     embed.add_field(name="Requested by", value=requester_mention)
     
     if data.queue:
         next_song = data.queue[0]
         embed.add_field(
             name="Next Song", 
-            value=f"[{next_song['title']}]({next_song['webpage_url']})", 
+            value=f"[{next_song.title}]({next_song.webpage_url})", 
             inline=False
         )
     
@@ -1053,11 +3218,10 @@ async def shuffle(ctx):
         await send_error(ctx, "Not enough songs in queue to shuffle!")
         return
     
-    queue_list = list(data.queue)
-    random.shuffle(queue_list)
-    data.queue = deque(queue_list)
+    data.queue.shuffle()
     data.last_interaction = datetime.now()
     data.last_activity = datetime.now()
+    schedule_prefetch(ctx.guild)
     
     await send_success(ctx, "Queue shuffled!")
 
@@ -1072,15 +3236,14 @@ async def remove(ctx, index: int):
         await send_error(ctx, f"Invalid position! Queue has {len(data.queue)} items.")
         return
     
-    queue_list = list(data.queue)
-    removed = queue_list.pop(index - 1)
-    data.queue = deque(queue_list)
+    removed = data.queue.pop(index - 1)
     data.last_interaction = datetime.now()
     data.last_activity = datetime.now()
+    schedule_prefetch(ctx.guild)
     
     embed = discord.Embed(
         title="🗑️ Removed from Queue",
-        description=f"[{removed['title']}]({removed['webpage_url']})",
+        description=f"[{removed.title}]({removed.webpage_url})",
         color=discord.Color.red()
     )
     await ctx.send(embed=embed)
@@ -1092,20 +3255,19 @@ async def remove(ctx, index: int):
 async def history(ctx, page: int = 1):
     """Show recently played tracks"""
     await send_info(ctx, "Fetching recently played tracks...")
-    async with aiosqlite.connect('musicbot.db') as db:
-        cursor = await db.execute("SELECT track_data FROM track_history WHERE guild_id = ? ORDER BY played_at DESC LIMIT 10 OFFSET ?", (ctx.guild.id, (page-1)*10))
-        rows = await cursor.fetchall()
+    await history_writer.flush()
+    rows = await database.get_history(ctx.guild.id, limit=10, offset=(page-1)*10)
     if not rows:
         await send_info(ctx, "No track history available!")
         return
     embed = discord.Embed(title="🎶 Recently Played", color=discord.Color.purple())
     for i, row in enumerate(rows, start=1):
-        track = json.loads(row[0])
-        requester = ctx.guild.get_member(track['requester'])
-        requester_mention = requester.mention if requester else str(track['requester'])
+        track = decode_track(row[0])
+        requester = ctx.guild.get_member(track.requester) if track.requester else None
+        requester_mention = requester.mention if requester else str(track.requester)
         embed.add_field(
-            name=f"{i}. {track['title']}",
-            value=f"[Link]({track['webpage_url']}) | Requested by {requester_mention}",
+            name=f"{i}. {track.title}",
+            value=f"[Link]({track.webpage_url}) | Requested by {requester_mention}",
             inline=False
         )
     embed.set_footer(text=f"Page {page}")
@@ -1116,27 +3278,25 @@ async def history(ctx, page: int = 1):
 async def replay(ctx, index: int = 1):
     """Replay a song from history"""
     await send_info(ctx, f"Replaying song number {index} from history...")
-    async with aiosqlite.connect('musicbot.db') as db:
-        cursor = await db.execute("SELECT track_data FROM track_history WHERE guild_id = ? ORDER BY played_at DESC LIMIT 1 OFFSET ?", (ctx.guild.id, index-1))
-        row = await cursor.fetchone()
+    await history_writer.flush()
+    rows = await database.get_history(ctx.guild.id, limit=1, offset=index-1)
+    row = rows[0] if rows else None
     if not row:
         await send_error(ctx, "No track found at that position in history!")
         return
-    track = json.loads(row[0])
-    track['requester'] = ctx.author.id
+    track = decode_track(row[0])
+    track.requester = ctx.author.id
     data = get_guild_data(ctx.guild.id)
     data.queue.append(track)
     data.last_interaction = datetime.now()
     data.last_activity = datetime.now()
-    voice_client = ctx.guild.voice_client
-    if not voice_client or not voice_client.is_playing():
-        await play_next(ctx.guild, ctx)
+    await get_playback(ctx.guild).submit('enqueue', ctx)
     embed = discord.Embed(
         title="✅ Added to Queue",
-        description=f"[{track['title']}]({track['webpage_url']})",
+        description=f"[{track.title}]({track.webpage_url})",
         color=discord.Color.green()
     )
-    embed.set_thumbnail(url=track['thumbnail'])
+    embed.set_thumbnail(url=track.thumbnail)
     embed.add_field(name="Position in queue", value=f"{len(data.queue)}")
     await ctx.send(embed=embed)
 
@@ -1158,12 +3318,10 @@ async def move(ctx, from_pos: int, to_pos: int):
         await send_info(ctx, "Song is already at that position!")
         return
     
-    queue_list = list(data.queue)
-    track = queue_list.pop(from_pos - 1)
-    queue_list.insert(to_pos - 1, track)
-    data.queue = deque(queue_list)
+    data.queue.move(from_pos - 1, to_pos - 1)
     data.last_interaction = datetime.now()
     data.last_activity = datetime.now()
+    schedule_prefetch(ctx.guild)
     
     await send_success(ctx, f"Moved track from position {from_pos} to {to_pos}!")
 
@@ -1182,7 +3340,7 @@ async def export_queue(ctx):
         'guild_id': ctx.guild.id,
         'exported_by': str(ctx.author),
         'exported_at': str(datetime.now()),
-        'tracks': data.to_serializable()
+        'tracks': [track.to_dict() for track in data.queue]
     }
     
     with open(f'queue_export_{ctx.guild.id}.json', 'w') as f:
@@ -1212,13 +3370,11 @@ async def import_queue(ctx):
         return
     
     data = get_guild_data(ctx.guild.id)
-    data.queue = deque(queue_data['tracks'])
+    data.queue = TrackQueue(Track.from_export(track) for track in queue_data['tracks'])
     data.last_interaction = datetime.now()
     data.last_activity = datetime.now()
     
-    voice_client = ctx.guild.voice_client
-    if not voice_client or not voice_client.is_playing():
-        await play_next(ctx.guild, ctx)
+    await get_playback(ctx.guild).submit('enqueue', ctx)
     
     await send_success(ctx, f"Imported {len(data.queue)} tracks to the queue!")
 
@@ -1226,9 +3382,7 @@ async def import_queue(ctx):
 @command_error_handler
 async def list_playlists(ctx):
     """List all saved playlists"""
-    async with aiosqlite.connect('musicbot.db') as db:
-        cursor = await db.execute("SELECT id, name, is_public FROM playlists WHERE guild_id = ? OR is_public = 1 ORDER BY name", (ctx.guild.id,))
-        playlists = await cursor.fetchall()
+    playlists = await database.list_playlists(ctx.guild.id)
         
     if not playlists:
         await send_info(ctx, "No playlists found!")
@@ -1251,34 +3405,25 @@ async def list_playlists(ctx):
 async def load_playlist(ctx, playlist_id: int):
     """Load a saved playlist"""
     await send_info(ctx, f"Loading playlist with ID {playlist_id}...")
-    async with aiosqlite.connect('musicbot.db') as db:
-        cursor = await db.execute("SELECT name, tracks FROM playlists WHERE id = ? AND (guild_id = ? OR is_public = 1)", 
-                               (playlist_id, ctx.guild.id))
-        playlist = await cursor.fetchone()
+    playlist = await database.get_playlist(playlist_id, ctx.guild.id)
         
     if not playlist:
         await send_error(ctx, "Playlist not found or you don't have permission to access it!")
         return
     
     data = get_guild_data(ctx.guild.id)
-    tracks = json.loads(playlist[1])
+    tracks = decode_tracks(playlist[1])
     
     for track in tracks:
-        # Convert requester string back to Member object if possible
-        if isinstance(track['requester'], str):
-            try:
-                user_id = int(track['requester'])
-                track['requester'] = ctx.guild.get_member(user_id) or ctx.author
-            except:
-                track['requester'] = ctx.author
+        # Tracks without a known requester are credited to whoever loaded the playlist
+        if track.requester is None:
+            track.requester = ctx.author.id
         data.queue.append(track)
     
     data.last_interaction = datetime.now()
     data.last_activity = datetime.now()
     
-    voice_client = ctx.guild.voice_client
-    if not voice_client or not voice_client.is_playing():
-        await play_next(ctx.guild, ctx)
+    await get_playback(ctx.guild).submit('enqueue', ctx)
     
     await send_success(ctx, f"Loaded playlist '{playlist[0]}' with {len(tracks)} tracks!")
 
@@ -1287,18 +3432,14 @@ async def load_playlist(ctx, playlist_id: int):
 async def delete_playlist(ctx, playlist_id: int):
     """Delete a saved playlist"""
     await send_info(ctx, f"Deleting playlist with ID {playlist_id}...")
-    async with aiosqlite.connect('musicbot.db') as db:
-        # Check if playlist exists and belongs to the user
-        cursor = await db.execute("SELECT name FROM playlists WHERE id = ? AND guild_id = ? AND user_id = ?", 
-                               (playlist_id, ctx.guild.id, ctx.author.id))
-        playlist = await cursor.fetchone()
-        
-        if not playlist:
-            await send_error(ctx, "Playlist not found or you don't have permission to delete it!")
-            return
-        
-        await db.execute("DELETE FROM playlists WHERE id = ?", (playlist_id,))
-        await db.commit()
+    # Check if playlist exists and belongs to the user
+    playlist = await database.get_owned_playlist(playlist_id, ctx.guild.id, ctx.author.id)
+    
+    if not playlist:
+        await send_error(ctx, "Playlist not found or you don't have permission to delete it!")
+        return
+    
+    await database.delete_playlist(playlist_id)
     
     await send_success(ctx, f"Deleted playlist '{playlist[0]}'!")
 
@@ -1307,18 +3448,14 @@ async def delete_playlist(ctx, playlist_id: int):
 async def share_playlist(ctx, playlist_id: int, public: bool = True):
     """Set playlist sharing status"""
     await send_info(ctx, f"Setting sharing status for playlist ID {playlist_id}...")
-    async with aiosqlite.connect('musicbot.db') as db:
-        # Check if playlist exists and belongs to the user
-        cursor = await db.execute("SELECT name FROM playlists WHERE id = ? AND guild_id = ? AND user_id = ?", 
-                               (playlist_id, ctx.guild.id, ctx.author.id))
-        playlist = await cursor.fetchone()
-        
-        if not playlist:
-            await send_error(ctx, "Playlist not found or you don't have permission to modify it!")
-            return
-        
-        await db.execute("UPDATE playlists SET is_public = ? WHERE id = ?", (int(public), playlist_id))
-        await db.commit()
+    # Check if playlist exists and belongs to the user
+    playlist = await database.get_owned_playlist(playlist_id, ctx.guild.id, ctx.author.id)
+    
+    if not playlist:
+        await send_error(ctx, "Playlist not found or you don't have permission to modify it!")
+        return
+    
+    await database.set_playlist_public(playlist_id, public)
     
     await send_success(ctx, f"Playlist '{playlist[0]}' is now {'public' if public else 'private'}!")
 
@@ -1332,16 +3469,8 @@ async def toggle_247(ctx):
     data.last_interaction = datetime.now()
     data.last_activity = datetime.now()
     
-    # Save to database
-    try:
-        async with aiosqlite.connect('musicbot.db') as db:
-            await db.execute("INSERT OR REPLACE INTO guild_settings (guild_id, stay_24_7) VALUES (?, ?)", 
-                           (ctx.guild.id, int(data.stay_24_7)))
-            await db.commit()
-        await send_success(ctx, f"24/7 mode is now {'enabled' if data.stay_24_7 else 'disabled'}!")
-    except Exception as e:
-        await handle_db_error(ctx, e)
-        return
+    guild_settings.update(ctx.guild.id, stay_24_7=int(data.stay_24_7))
+    await send_success(ctx, f"24/7 mode is now {'enabled' if data.stay_24_7 else 'disabled'}!")
 
 @bot.command(name="autodisconnect")
 @command_error_handler
@@ -1353,16 +3482,8 @@ async def toggle_auto_disconnect(ctx):
     data.last_interaction = datetime.now()
     data.last_activity = datetime.now()
     
-    # Save to database
-    try:
-        async with aiosqlite.connect('musicbot.db') as db:
-            await db.execute("INSERT OR REPLACE INTO guild_settings (guild_id, auto_disconnect) VALUES (?, ?)", 
-                           (ctx.guild.id, int(data.auto_disconnect)))
-            await db.commit()
-        await send_success(ctx, f"Auto-disconnect is now {'enabled' if data.auto_disconnect else 'disabled'}!")
-    except Exception as e:
-        await handle_db_error(ctx, e)
-        return
+    guild_settings.update(ctx.guild.id, auto_disconnect=int(data.auto_disconnect))
+    await send_success(ctx, f"Auto-disconnect is now {'enabled' if data.auto_disconnect else 'disabled'}!")
 
 @bot.command(name="filter")
 @command_error_handler
@@ -1374,23 +3495,20 @@ async def set_filter(ctx, filter_name: str = None):
         return
     
     data = get_guild_data(ctx.guild.id)
-    data.audio_filter = AUDIO_FILTERS.get(filter_name.lower() if filter_name else None)
+    data.audio_filter = filter_preset_name(filter_name.lower()) if filter_name else None
     data.last_interaction = datetime.now()
     data.last_activity = datetime.now()
     
-    # Save to database
-    async with aiosqlite.connect('musicbot.db') as db:
-        await db.execute("INSERT OR REPLACE INTO guild_settings (guild_id, audio_filter) VALUES (?, ?)", 
-                       (ctx.guild.id, filter_name.lower() if filter_name else None))
-        await db.commit()
+    guild_settings.update(ctx.guild.id, audio_filter=data.audio_filter)
     
-    # If a song is currently playing, restart it with the new filter
+    # The prefetched source was built with the old filter
+    invalidate_prefetch(data)
+
+    # If a song is currently playing, restart it with the new filter where it is now
     voice_client = ctx.guild.voice_client
     if voice_client and voice_client.is_playing():
-        # Save current position if possible (not implemented, so just restart)
-        voice_client.stop()
-        await send_info(ctx, "Restarting current song with new filter...")
-        await play_next(ctx.guild, ctx)
+        await send_info(ctx, "Applying the filter to the current song...")
+        await get_playback(ctx.guild).submit('restart', ctx)
     
     if filter_name:
         await send_success(ctx, f"Audio filter set to '{filter_name}'!")
@@ -1419,9 +3537,9 @@ async def get_lyrics(ctx, query: str = None):
         elif hasattr(data, 'last_played_title') and data.last_played_title:
             query = data.last_played_title
         elif data.now_playing:
-            query = data.now_playing['title']
+            query = data.now_playing.title
         elif data.queue:
-            query = data.queue[-1]['title']
+            query = data.queue[-1].title
         else:
             await send_error(ctx, "Please provide a song name or play a song first!")
             return
@@ -1469,9 +3587,9 @@ async def recommend(ctx, count: int = 3):
     # Get a list of artists from current queue
     artists = set()
     if data.now_playing:
-        artists.add(data.now_playing['uploader'])
+        artists.add(data.now_playing.uploader)
     for track in data.queue:
-        artists.add(track['uploader'])
+        artists.add(track.uploader)
     
     if not artists:
         await send_error(ctx, "Couldn't determine artists for recommendations!")
@@ -1492,10 +3610,10 @@ async def recommend(ctx, count: int = 3):
     
     embed = discord.Embed(title="🎧 Recommended Tracks", color=discord.Color.purple())
     
-    for i, track in enumerate(related_tracks[:count], start=1):
+    for i, result in enumerate(related_tracks[:count], start=1):
         embed.add_field(
-            name=f"{i}. {track['title']}",
-            value=f"by {track['uploader']}",
+            name=f"{i}. {result['title']}",
+            value=f"by {result['uploader']}",
             inline=False
         )
     
@@ -1520,6 +3638,7 @@ async def help_command(ctx):
         ("!pause", "Temporarily pause the current playback."),
         ("!resume", "Continue playing the paused track."),
         ("!skip", "Move to the next song in your queue."),
+        ("!seek <time>", "Jump to a position in the current song, e.g. 1:30."),
         ("!stop", "End playback and clear your current queue."),
         ("!leave", "Disconnect the bot from your voice channel.")
     ]
@@ -1611,14 +3730,11 @@ async def save_playlist(ctx, name: str):
     if not data.queue:
         await send_error(ctx, "The queue is empty!")
         return
-    async with aiosqlite.connect('musicbot.db') as db:
-        cursor = await db.execute("SELECT id FROM playlists WHERE guild_id = ? AND user_id = ? AND name = ?", (ctx.guild.id, ctx.author.id, name))
-        existing = await cursor.fetchone()
-        if existing:
-            await send_error(ctx, f"You already have a playlist named '{name}'!")
-            return
-        await db.execute("INSERT INTO playlists (guild_id, user_id, name, tracks) VALUES (?, ?, ?, ?)", (ctx.guild.id, ctx.author.id, name, json.dumps(data.to_serializable())))
-        await db.commit()
+    existing = await database.find_playlist(ctx.guild.id, ctx.author.id, name)
+    if existing:
+        await send_error(ctx, f"You already have a playlist named '{name}'!")
+        return
+    await database.create_playlist(ctx.guild.id, ctx.author.id, name, data.to_serializable())
     await send_success(ctx, f"Playlist '{name}' saved!")
 
 # Audio quality selector
@@ -1641,18 +3757,90 @@ async def set_quality(ctx, level: str = 'high'):
     data = get_guild_data(ctx.guild.id)
     data.quality = level.lower()
     ytdl_format_options['format'] = qualities[level.lower()]
-    # Save to DB
-    async with aiosqlite.connect('musicbot.db') as db:
-        await db.execute("INSERT OR REPLACE INTO guild_settings (guild_id, volume, loop, stay_timeout, stay_24_7, auto_disconnect, audio_filter) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (ctx.guild.id, data.volume, int(data.loop), 300, int(data.stay_24_7), int(data.auto_disconnect), data.audio_filter))
-        await db.commit()
-    await send_success(ctx, f"Quality set to {level.lower()}! This will apply to the next song you play.")
-
-# Background task to check empty voice channels
-@tasks.loop(seconds=15)
-async def check_voice_channels():
-    for guild in bot.guilds:
-        await check_empty_voice(guild)
+    voice_client = ctx.guild.voice_client
+    if voice_client and voice_client.is_playing() and data.now_playing and data.now_playing.webpage_url:
+        # The cached stream is in the old format, so this one restart has to extract again
+        stream_cache.invalidate(data.now_playing.webpage_url)
+        await get_playback(ctx.guild).submit('restart', ctx)
+        await send_success(ctx, f"Quality set to {level.lower()}!")
+    else:
+        await send_success(ctx, f"Quality set to {level.lower()}! This will apply to the next song you play.")
+
+# Owner-only performance overview
+@bot.command(name="stats")
+@command_error_handler
+async def stats(ctx):
+    """Stage latencies over the last few minutes, caches and load (bot owner only)"""
+    if not await bot.is_owner(ctx.author):
+        await send_error(ctx, "Only the bot owner can use this command!")
+        return
+    embed = discord.Embed(title="📊 Bot Stats", color=discord.Color.dark_teal())
+    lines = []
+    for stage, ordered in sorted(metrics.rolling().items()):
+        if ordered:
+            p50, p95 = (pick_percentile(ordered, q) * 1000 for q in (0.5, 0.95))
+            lines.append(f"`{stage}` p50 {p50:.0f} ms • p95 {p95:.0f} ms • max {ordered[-1] * 1000:.0f} ms • n={len(ordered)}")
+    embed.add_field(name=f"⏱️ Latency (last {METRICS_WINDOW // 60} min)", value="\n".join(lines) or "No samples yet", inline=False)
+    collected = metrics.read_collectors()
+    lookups = collected.get('cache_lookups_total', {})
+    cache_lines = []
+    for cache in ('stream', 'audio'):
+        hits, misses = lookups.get((cache, 'hit'), 0), lookups.get((cache, 'miss'), 0)
+        rate = f"{hits / (hits + misses):.0%}" if hits + misses else "n/a"
+        cache_lines.append(f"{cache.title()}: {hits} hits / {misses} misses ({rate})")
+    cache_lines.append(f"Coalesced extractions: {collected.get('extractions_coalesced_total', 0)}")
+    embed.add_field(name="🗃️ Caches", value="\n".join(cache_lines), inline=False)
+    extractions = collected.get('extractions_total', {})
+    embed.add_field(name="⛏️ Extraction", value=(
+        f"In flight: {collected.get('extraction_in_flight', 0)} (waiting: {collected.get('extraction_queue_depth', 0)})\n"
+        + " • ".join(f"{result}: {count}" for (result,), count in extractions.items())), inline=False)
+    errors = [f"{dict(labels)['stage']}: {count}" for labels, count in sorted(metrics.counter_values('stage_errors').items())]
+    embed.add_field(name="🔊 Load", value=(
+        f"Voice clients: {collected.get('voice_clients', 0)} • Guilds in memory: {collected.get('guild_states', 0)}\n"
+        f"Queued tracks: {collected.get('queued_tracks', 0)} (longest {collected.get('longest_queue', 0)})\n"
+        f"Pending history rows: {collected.get('history_pending', 0)} • Dirty queues: {collected.get('dirty_queues', 0)}"), inline=False)
+    if errors:
+        embed.add_field(name="⚠️ Stage errors", value=" • ".join(errors), inline=False)
+    uptime = int(collected.get('uptime_seconds', 0))
+    embed.set_footer(text=f"Uptime {format_duration(uptime)}" + (f" • Prometheus on port {METRICS_PORT}" if metrics_runner else ""))
+    await ctx.send(embed=embed)
+
+@bot.command(name="slowcommands")
+@command_error_handler
+async def slow_commands(ctx, count: int = 10):
+    """Per-command summary of the slow invocations in the profiling log (bot owner only).
+    Arguments and cProfile traces stay in the log on the host, they aren't posted to the channel"""
+    if not await bot.is_owner(ctx.author):
+        await send_error(ctx, "Only the bot owner can use this command!")
+        return
+    log = command_profiler.log
+    records = await asyncio.to_thread(log.recent, SLOW_COMMANDS_SCANNED)
+    status = (f"Profiling is on: {command_profiler.invocations} invocations timed, {command_profiler.stored} stored, "
+              f"{command_profiler.sample_rate:.0%} sampled with cProfile" if command_profiler.enabled
+              else "Profiling is off, set COMMAND_PROFILING=1 to turn it on.")
+    if not records:
+        await send_info(ctx, f"{status}\nNo slow invocations recorded.")
+        return
+    count = max(1, min(count, 15))
+    by_command = {}
+    for record in records:
+        by_command.setdefault(record['command'], []).append(record)
+    rows = []
+    for name, runs in sorted(by_command.items(), key=lambda item: -max(r['wall_ms'] for r in item[1]))[:count]:
+        walls = sorted(r['wall_ms'] for r in runs)
+        errors = sum(1 for r in runs if r.get('error'))
+        rows.append(f"`!{name}` {len(runs)}× • p50 {pick_percentile(walls, 0.5):.0f} ms • max {walls[-1]:.0f} ms • "
+                    f"longest block {max(r['longest_block_ms'] for r in runs):.0f} ms" + (f" • {errors} failed" if errors else ""))
+    blocks = []
+    for record in sorted(records, key=lambda r: -r['longest_block_ms'])[:5]:
+        where = record.get('longest_block_ended_at') or 'return'
+        where = "before returning" if where == 'return' else f"before awaiting in `{where[:120]}`"
+        blocks.append(f"`!{record['command']}` {record['longest_block_ms']:.0f} ms, {where}")
+    embed = discord.Embed(title="🐢 Slow Commands", description=f"{status}\nLast {len(records)} slow invocations", color=discord.Color.orange())
+    embed.add_field(name="By command (slowest first)", value="\n".join(rows)[:1024], inline=False)
+    embed.add_field(name="Longest event loop blocks", value="\n".join(blocks)[:1024], inline=False)
+    embed.set_footer(text=f"Full log with cProfile traces: {log.path}")
+    await ctx.send(embed=embed)
 
 # Status rotation setup
 status_messages = [
@@ -1683,13 +3871,27 @@ async def on_ready():
     print("╚════════════════════════════════════════╝")
 
     # Start background tasks
-    bot.loop.create_task(check_voice_channels())
+    idle_scheduler.start()
+    for voice_client in bot.voice_clients:
+        idle_scheduler.touch(voice_client.guild.id)
     if not rotate_status.is_running():
         rotate_status.start()
 
     # Initialize database and load queues
+    await database.connect()
+    await guild_settings.load()
+    guild_settings.start()
+    history_writer.start()
+    print("✓ Database connected")
+    await stream_cache.load()
+    await audio_cache.load()
     await load_queues()
     print("✓ Queues loaded from database")
+    if not checkpoint_queues.is_running():
+        checkpoint_queues.start()
+        cleanup_uploads.start()
+        install_shutdown_handlers()
+    await start_metrics_server()
 
     # Register slash commands
     await bot.tree.sync()
@@ -1701,10 +3903,10 @@ async def on_ready():
 async def search_queue(ctx, *, query: str):
     """Find specific songs within your current queue"""
     data = get_guild_data(ctx.guild.id)
-    matches = [t for t in data.queue if query.lower() in t['title'].lower()]
+    matches = [t for t in data.queue if query.lower() in t.title.lower()]
     embed = discord.Embed(title=f"🔍 Queue Results for '{query}'", color=discord.Color.blue())
     for track in list(matches)[:5]:
-        embed.add_field(name=track['title'], value=track['webpage_url'], inline=False)
+        embed.add_field(name=track.title, value=track.webpage_url, inline=False)
     if not matches:
         embed.description = "No matches found."
     await ctx.send(embed=embed)
@@ -1717,7 +3919,8 @@ async def toggle_autoplay(ctx):
     data.autoplay = not data.autoplay
     await send_success(ctx, f"Smart Autoplay is now {'enabled' if data.autoplay else 'disabled'}!")
 
-bot.run(TOKEN)
+if __name__ == '__main__':
+    bot.run(TOKEN)
 
 
 
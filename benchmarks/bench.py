@@ -0,0 +1,213 @@
+"""Offline benchmarks for Pancake.py: fake guilds and voice clients, stub yt-dlp, temp database.
+
+    python benchmarks/bench.py [--latency 0.2] [--output results.json]
+
+Prints one JSON document (times in milliseconds) so runs of different releases can be diffed.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import statistics
+import subprocess
+import time
+import tracemalloc
+
+import fakes
+from fakes import FakeContext, FakeYoutubeDL
+
+Pancake = fakes.install()
+
+
+def summarize(samples):
+    """p50/p90/max/mean in milliseconds"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {
+        'n': len(ordered),
+        'p50': round(pick(0.5) * 1000, 3),
+        'p90': round(pick(0.9) * 1000, 3),
+        'max': round(ordered[-1] * 1000, 3),
+        'mean': round(statistics.fmean(ordered) * 1000, 3),
+    }
+
+
+async def timed(coro):
+    start = time.perf_counter()
+    await coro
+    return time.perf_counter() - start
+
+
+async def wait_for(predicate, timeout=30):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise TimeoutError("benchmark condition not reached")
+        await asyncio.sleep(0.005)
+
+
+class Guilds:
+    """Hands out fresh fake guilds with one member in voice"""
+    def __init__(self):
+        self.next_id = 1000
+
+    def new(self):
+        self.next_id += 1
+        guild = fakes.make_guild(Pancake, self.next_id)
+        author = guild.member(self.next_id * 10)
+        return guild, FakeContext(guild, author)
+
+
+async def bench_time_to_first_audio(guilds, runs):
+    """play command -> first frame read by the voice client, for a cold and a cached stream"""
+    cold, warm = [], []
+    for i in range(runs):
+        for samples in (cold, warm):
+            guild, ctx = guilds.new()
+            start = time.perf_counter()
+            await Pancake.play.callback(ctx, query=f"time to first audio {i}")
+            await wait_for(lambda: guild.voice_client and guild.voice_client.first_reads)
+            samples.append(guild.voice_client.first_reads[0] - start)
+            await Pancake.get_playback(guild).submit('stop')
+    return {'cold': summarize(cold), 'stream_cached': summarize(warm)}
+
+
+async def bench_inter_track_gap(guilds, tracks):
+    """Silence between one track ending and the next one's first frame, with prefetching"""
+    guild, ctx = guilds.new()
+    for i in range(tracks):
+        await Pancake.play.callback(ctx, query=f"gap track {i}")
+    data = Pancake.get_guild_data(guild.id)
+    await wait_for(lambda: len(guild.voice_client.first_reads) >= tracks, timeout=tracks * (FakeYoutubeDL.track_seconds + 5))
+    await wait_for(lambda: not guild.voice_client.is_playing(), timeout=FakeYoutubeDL.track_seconds + 5)
+    return summarize(list(data.track_gaps))
+
+
+async def bench_queue_operations(guilds, sizes, repeats):
+    """Command latency for queue/remove/move/shuffle against the queue length (no voice connection)"""
+    results = {}
+    for size in sizes:
+        guild, ctx = guilds.new()
+        data = Pancake.get_guild_data(guild.id)
+        data.queue.extend(Pancake.Track(f"Queued {i}", 180, f"https://www.youtube.com/watch?v=q{size}x{i}", requester=ctx.author.id)
+                          for i in range(size))
+        samples = {'queue': [], 'remove': [], 'move': [], 'shuffle': []}
+        for _ in range(repeats):
+            samples['queue'].append(await timed(Pancake.queue.callback(ctx, max(1, size // 20))))
+            samples['move'].append(await timed(Pancake.move.callback(ctx, 1, size)))
+            samples['shuffle'].append(await timed(Pancake.shuffle.callback(ctx)))
+            samples['remove'].append(await timed(Pancake.remove.callback(ctx, max(1, size // 2))))
+            data.queue.append(Pancake.Track("Refill", 180, "https://www.youtube.com/watch?v=refill"))
+        Pancake.invalidate_prefetch(data)
+        results[str(size)] = {name: summarize(values) for name, values in samples.items()}
+    return results
+
+
+async def bench_history_and_playlists(guilds, repeats, playlist_size):
+    guild, ctx = guilds.new()
+    for i in range(Pancake.HISTORY_LIMIT):
+        Pancake.history_writer.add(guild.id, Pancake.Track(f"History {i}", 200, f"https://www.youtube.com/watch?v=h{i}", requester=ctx.author.id))
+    await Pancake.history_writer.flush()
+    history = [await timed(Pancake.history.callback(ctx, page)) for page in range(1, repeats + 1)]
+
+    tracks = [Pancake.Track(f"Playlist {i}", 200, f"https://www.youtube.com/watch?v=p{i}") for i in range(playlist_size)]
+    playlist_id = await Pancake.database.create_playlist(guild.id, ctx.author.id, "bench", Pancake.encode_tracks(tracks))
+    loads = []
+    for _ in range(repeats):
+        loads.append(await timed(Pancake.load_playlist.callback(ctx, playlist_id)))
+        Pancake.get_guild_data(guild.id).queue.clear()
+    return {'history': summarize(history), f'load_playlist_{playlist_size}': summarize(loads)}
+
+
+async def bench_database(repeats):
+    db = Pancake.database
+    results = {'single_write': [], 'save_queues_100_guilds': [], 'history_batch_50': [], 'settings_flush_100_guilds': []}
+    queue_json = Pancake.encode_tracks(Pancake.Track(f"Saved {i}", 200, f"https://www.youtube.com/watch?v=s{i}") for i in range(50))
+    track_json = Pancake.encode_track(Pancake.Track("Played", 200, "https://www.youtube.com/watch?v=played"))
+    for r in range(repeats):
+        results['single_write'].append(await timed(db.set_playlist_public(1, r % 2)))
+        results['save_queues_100_guilds'].append(await timed(db.save_queues([(g, queue_json) for g in range(100)])))
+        rows = [(r % 10, track_json, f"2024-01-01 00:{r % 60:02d}:{i:02d}") for i in range(50)]
+        results['history_batch_50'].append(await timed(db.add_history_batch(rows)))
+        for g in range(100):
+            Pancake.guild_settings.update(g, volume=(r % 10) / 10)
+        results['settings_flush_100_guilds'].append(await timed(Pancake.guild_settings.flush()))
+    return {name: summarize(values) for name, values in results.items()}
+
+
+def bench_memory_per_guild(guild_count, queue_lengths):
+    """tracemalloc bytes per GuildData, empty and with queued tracks"""
+    results = {}
+    for length in queue_lengths:
+        ids = range(10_000_000, 10_000_000 + guild_count)
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        for guild_id in ids:
+            data = Pancake.get_guild_data(guild_id)
+            data.queue.extend(Pancake.Track(f"Memory {i}", 200, f"https://www.youtube.com/watch?v=m{guild_id}x{i}", requester=guild_id)
+                              for i in range(length))
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        allocated = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+        results[str(length)] = round(allocated / guild_count)
+        for guild_id in ids:
+            del Pancake.guild_data[guild_id]
+        Pancake.dirty_queues.clear()
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main(args):
+    random.seed(args.seed)
+    FakeYoutubeDL.latency = args.latency
+    FakeYoutubeDL.track_seconds = args.track_seconds
+    await fakes.setup(Pancake)
+    guilds = Guilds()
+    try:
+        results = {
+            'time_to_first_audio_ms': await bench_time_to_first_audio(guilds, args.runs),
+            'inter_track_gap_ms': await bench_inter_track_gap(guilds, args.gap_tracks),
+            'queue_ops_ms': await bench_queue_operations(guilds, args.queue_sizes, args.runs),
+            'commands_ms': await bench_history_and_playlists(guilds, args.runs, args.playlist_size),
+            'db_write_ms': await bench_database(args.runs),
+            'memory_bytes_per_guild': bench_memory_per_guild(args.memory_guilds, (0, 100)),
+            'extraction': Pancake.extraction.stats(),
+            'yt_dlp_calls': FakeYoutubeDL.calls,
+        }
+    finally:
+        await fakes.teardown(Pancake)
+    return {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'config': vars(args),
+        'results': results,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--latency', type=float, default=0.2, help="seconds per stub yt-dlp extraction")
+    parser.add_argument('--track-seconds', type=float, default=1.0, help="length of every fake track")
+    parser.add_argument('--runs', type=int, default=10, help="samples per measurement")
+    parser.add_argument('--gap-tracks', type=int, default=5, help="tracks played back to back for the gap measurement")
+    parser.add_argument('--queue-sizes', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    parser.add_argument('--playlist-size', type=int, default=200)
+    parser.add_argument('--memory-guilds', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="also write the JSON here")
+    args = parser.parse_args()
+    report = asyncio.run(main(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
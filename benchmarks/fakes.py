@@ -0,0 +1,318 @@
+"""Local stand-ins for Discord and yt-dlp, so Pancake.py can be driven without a network.
+
+Import this module before anything else from the benchmarks: it points the bot at a temp
+database and thread-mode extraction, then imports Pancake with the fakes installed.
+"""
+import asyncio
+import hashlib
+import itertools
+import os
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse, parse_qs
+
+WORK_DIR = tempfile.mkdtemp(prefix='pancake-bench-')
+os.environ['DB_PATH'] = os.path.join(WORK_DIR, 'musicbot.db')
+os.environ['UPLOAD_DIR'] = os.path.join(WORK_DIR, 'uploads')
+os.environ['EXTRACTION_MODE'] = 'thread'  # The stub YoutubeDL only exists in this process
+os.environ['STREAM_CACHE_PERSIST'] = '0'
+os.environ['AUDIO_CACHE_DIR'] = ''
+os.environ['PLAYBACK_MODE'] = 'pcm'
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discord
+import yt_dlp
+from aiohttp import web
+
+FRAME_SECONDS = 0.02  # discord.py reads one 20 ms frame at a time
+FRAME = b'\x00' * discord.opus.Encoder.FRAME_SIZE
+
+
+class FakeYoutubeDL:
+    """Answers extract_info after a configurable delay, with results shaped like yt-dlp's"""
+    latency = 0.2  # Seconds per extraction
+    track_seconds = 2  # Duration of every fake track
+    calls = 0
+
+    def __init__(self, options=None):
+        self.options = options or {}
+
+    @classmethod
+    def info(cls, query):
+        video_id = hashlib.sha1(query.encode()).hexdigest()[:11]
+        return {
+            'id': video_id,
+            'title': f"Fake track {query[:40]}",
+            'url': f"fake://{video_id}?d={cls.track_seconds}",
+            'duration': cls.track_seconds,
+            'webpage_url': f"https://www.youtube.com/watch?v={video_id}",
+            'thumbnail': f"https://i.ytimg.com/vi/{video_id}/hqdefault.jpg",
+            'uploader': "Fake uploader",
+            'acodec': 'opus',
+            'ext': 'webm',
+        }
+
+    def extract_info(self, url, download=False):
+        FakeYoutubeDL.calls += 1
+        time.sleep(self.latency)
+        if url.startswith('ytsearch'):
+            prefix, _, query = url.partition(':')
+            count = int(prefix[len('ytsearch'):] or 1)
+            return {'entries': [self.info(f"{query} #{i}") for i in range(count)]}
+        return self.info(url)
+
+    def prepare_filename(self, info):
+        return info['url']
+
+    def sanitize_info(self, info):
+        return info
+
+
+class FakeFFmpegPCMAudio(discord.AudioSource):
+    """Silent PCM for the duration encoded in a fake:// URL, honouring -ss"""
+    def __init__(self, source, *, before_options=None, options=None, **kwargs):
+        query = parse_qs(urlparse(source).query)
+        seconds = float(query.get('d', [FakeYoutubeDL.track_seconds])[0])
+        args = (before_options or '').split()
+        if '-ss' in args:
+            seconds -= float(args[args.index('-ss') + 1])
+        self.frames = max(0, int(seconds / FRAME_SECONDS))
+        self.cleaned_up = False
+
+    def read(self):
+        if self.frames <= 0:
+            return b''
+        self.frames -= 1
+        return FRAME
+
+    def is_opus(self):
+        return False
+
+    def cleanup(self):
+        self.cleaned_up = True
+
+
+class FakeVoiceClient:
+    """Reads the source every 20 ms on its own thread, like discord.py's AudioPlayer"""
+    def __init__(self, channel):
+        self.channel = channel
+        self.guild = channel.guild
+        self.source = None
+        self._paused = threading.Event()
+        self._stopped = None
+        self._thread = None
+        self.first_reads = []  # perf_counter() of the first frame of every source played
+        self.frames_read = 0
+
+    def is_connected(self):
+        return True
+
+    def _active(self):
+        return self._stopped is not None and not self._stopped.is_set()
+
+    def is_playing(self):
+        return self._active() and not self._paused.is_set()
+
+    def is_paused(self):
+        return self._active() and self._paused.is_set()
+
+    def play(self, source, *, after=None):
+        if self.is_playing() or self.is_paused():
+            raise discord.ClientException('Already playing audio.')
+        self.source = source
+        self._paused.clear()
+        stopped = self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(source, after, stopped), daemon=True)
+        self._thread.start()
+
+    def _run(self, source, after, stopped):
+        first = True
+        next_frame = time.perf_counter()
+        while not stopped.is_set():
+            if self._paused.is_set():
+                time.sleep(FRAME_SECONDS)
+                next_frame = time.perf_counter()
+                continue
+            data = source.read()
+            if first:
+                self.first_reads.append(time.perf_counter())
+                first = False
+            if not data:
+                break
+            self.frames_read += 1
+            next_frame += FRAME_SECONDS
+            delay = next_frame - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        stopped.set()  # Ended before after() runs, so after() may start the next source
+        source.cleanup()
+        if after is not None:
+            after(None)
+
+    def pause(self):
+        self._paused.set()
+
+    def resume(self):
+        self._paused.clear()
+
+    def stop(self):
+        # Like discord.py, the player is detached right away; its thread winds down and calls after() on its own
+        if self._stopped is not None:
+            self._stopped.set()
+        self._thread = None
+        self._stopped = None
+
+    async def disconnect(self, *, force=False):
+        self.stop()
+        self.guild.voice_client = None
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+
+class FakeMember:
+    def __init__(self, member_id, guild, channel=None):
+        self.id = member_id
+        self.guild = guild
+        self.display_name = f"user{member_id}"
+        self.mention = f"<@{member_id}>"
+        self.voice = type('VoiceState', (), {'channel': channel})() if channel else None
+
+
+class FakeVoiceChannel:
+    def __init__(self, guild):
+        self.guild = guild
+        self.members = []
+
+    async def connect(self, *, self_deaf=False, **kwargs):
+        self.guild.voice_client = FakeVoiceClient(self)
+        return self.guild.voice_client
+
+
+class FakeTextChannel:
+    def __init__(self):
+        self.sent = 0
+
+    async def send(self, content=None, *, embed=None, **kwargs):
+        self.sent += 1
+        return FakeMessage(self)
+
+
+class FakeMessage:
+    def __init__(self, channel):
+        self.channel = channel
+        self.attachments = []
+
+    async def edit(self, **kwargs):
+        pass
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.voice_client = None
+        self.system_channel = None
+        self.voice_channel = FakeVoiceChannel(self)
+        self.text_channel = FakeTextChannel()
+        self.members = {}
+
+    def get_member(self, member_id):
+        return self.members.get(member_id)
+
+    async def change_voice_state(self, **kwargs):
+        pass
+
+    def member(self, member_id):
+        """A member sitting in the guild's voice channel"""
+        member = self.members[member_id] = FakeMember(member_id, self, self.voice_channel)
+        self.voice_channel.members.append(member)
+        return member
+
+
+class AttachmentServer:
+    """Serves generated audio files over HTTP on localhost, standing in for Discord's attachment CDN"""
+    def __init__(self, count, size):
+        self.directory = os.path.join(WORK_DIR, 'attachments')
+        self.names = [f"upload-{i}.mp3" for i in range(count)]
+        self.ids = itertools.count(1)
+        self.runner = None
+        self.url = None
+        os.makedirs(self.directory, exist_ok=True)
+        for name in self.names:
+            # Distinct content per file, so every name is stored once in UPLOAD_DIR
+            with open(os.path.join(self.directory, name), 'wb') as f:
+                f.write(hashlib.sha256(name.encode()).digest() * (size // 32))
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_static('/', self.directory)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '127.0.0.1', 0).start()
+        host, port = self.runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}"
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    def attachment(self, name):
+        return FakeAttachment(next(self.ids), name, os.path.getsize(os.path.join(self.directory, name)), f"{self.url}/{name}")
+
+
+class FakeAttachment:
+    def __init__(self, attachment_id, filename, size, url):
+        self.id = attachment_id
+        self.filename = filename
+        self.size = size
+        self.url = url
+
+
+class FakeContext:
+    """Enough of commands.Context for the command callbacks"""
+    def __init__(self, guild, author):
+        self.guild = guild
+        self.author = author
+        self.channel = guild.text_channel
+        self.message = FakeMessage(guild.text_channel)
+
+    async def send(self, content=None, *, embed=None, **kwargs):
+        return await self.channel.send(content, embed=embed, **kwargs)
+
+
+def install():
+    """Swap the fakes in and import the bot. Returns the Pancake module"""
+    yt_dlp.YoutubeDL = FakeYoutubeDL
+    discord.FFmpegPCMAudio = FakeFFmpegPCMAudio
+    import Pancake
+    guilds = {}
+    Pancake.bot.get_guild = guilds.get
+    Pancake.fake_guilds = guilds
+    return Pancake
+
+
+def make_guild(Pancake, guild_id):
+    guild = Pancake.fake_guilds[guild_id] = FakeGuild(guild_id)
+    return guild
+
+
+async def setup(Pancake):
+    """What on_ready does, minus Discord"""
+    Pancake.bot.loop = asyncio.get_running_loop()
+    await Pancake.database.connect()
+    await Pancake.guild_settings.load()
+    Pancake.history_writer.start()
+    Pancake.guild_settings.start()
+
+
+async def teardown(Pancake):
+    Pancake.idle_scheduler.stop()
+    await Pancake.history_writer.stop()
+    await Pancake.guild_settings.stop()
+    await Pancake.database.close()
+    if Pancake.http_session is not None:
+        await Pancake.http_session.close()
+    Pancake.extraction.shutdown()
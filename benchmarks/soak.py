@@ -0,0 +1,319 @@
+"""Multi-guild soak test: N fake guilds issue a random mix of commands against the offline fakes
+while event-loop lag, RSS, open file descriptors, threads and per-guild state are sampled.
+
+    python benchmarks/soak.py --guilds 500 --duration 120 --seed 1 --output soak.json
+
+Runs with the same seed issue the same commands. Exits with status 1 when a regression check fails
+(state that keeps growing when it should stay flat).
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import threading
+import time
+
+import fakes
+from fakes import AttachmentServer, FakeContext, FakeYoutubeDL
+
+Pancake = fakes.install()
+
+LAG_INTERVAL = 0.05  # Seconds between event-loop lag probes
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def open_fds():
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+
+def count_files(directory, suffix=''):
+    try:
+        return sum(1 for name in os.listdir(directory) if name.endswith(suffix))
+    except OSError:
+        return 0
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else None
+
+
+class LagProbe:
+    """Measures how late asyncio.sleep wakes up, i.e. how long something blocked the loop"""
+    def __init__(self):
+        self.samples = []
+
+    async def run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(LAG_INTERVAL)
+            self.samples.append(time.perf_counter() - start - LAG_INTERVAL)
+
+    def take(self):
+        samples, self.samples = self.samples, []
+        return samples
+
+
+class StartFailures:
+    """Counts tracks the playback actor failed to start. The actor handles those itself,
+    so the command calls never see them"""
+    def __init__(self):
+        self.count = 0
+        start = Pancake.PlaybackActor._start
+
+        async def counted(actor, track, *args, **kwargs):
+            try:
+                return await start(actor, track, *args, **kwargs)
+            except Exception as e:
+                self.count += 1
+                if self.count == 1:
+                    print(f"guild {actor.guild.id}: starting {track.title!r} failed: {e!r}")
+                raise
+        Pancake.PlaybackActor._start = counted
+
+
+class SimGuild:
+    def __init__(self, guild_id, seed, args, attachments):
+        self.guild = fakes.make_guild(Pancake, guild_id)
+        self.ctx = FakeContext(self.guild, self.guild.member(guild_id * 10))
+        self.rng = random.Random(seed * 1_000_003 + guild_id)
+        self.args = args
+        self.attachments = attachments
+        self.ops = {}
+        self.errors = 0
+        self.task = None
+
+    async def run(self, stop_at):
+        names, weights = zip(*self.args.mix.items())
+        while time.monotonic() < stop_at:
+            await asyncio.sleep(self.rng.expovariate(self.args.rate))
+            op = self.rng.choices(names, weights)[0]
+            try:
+                await getattr(self, f'op_{op}')()
+                self.ops[op] = self.ops.get(op, 0) + 1
+            except Exception as e:
+                self.errors += 1
+                if self.errors == 1:
+                    print(f"guild {self.guild.id}: {op} failed: {e!r}")
+
+    async def op_play(self):
+        if len(Pancake.get_guild_data(self.guild.id).queue) >= self.args.max_queue:
+            return
+        await Pancake.play.callback(self.ctx, query=f"soak track {self.rng.randrange(self.args.query_pool)}")
+
+    async def op_upload(self):
+        """!play with an audio file attached, downloaded from the local attachment server"""
+        data = Pancake.get_guild_data(self.guild.id)
+        if len(data.queue) >= self.args.max_queue:
+            return
+        attachment = self.attachments.attachment(self.rng.choice(self.attachments.names))
+        ctx = FakeContext(self.guild, self.ctx.author)
+        ctx.message.attachments = [attachment]
+        await Pancake.play.callback(ctx)
+        # The command reports failures in the channel, so check that the file made it into the queue
+        latest = data.queue[-1] if data.queue else data.now_playing
+        if latest is None or latest.webpage_url != attachment.url or not os.path.exists(latest.local_path):
+            raise RuntimeError(f"{attachment.filename} was not queued")
+
+    async def op_skip(self):
+        voice_client = self.guild.voice_client
+        if voice_client and voice_client.is_playing():
+            await Pancake.skip.callback(self.ctx)
+
+    async def op_queue(self):
+        await Pancake.queue.callback(self.ctx, 1)
+
+    async def op_history(self):
+        await Pancake.history.callback(self.ctx, 1)
+
+    async def remove(self):
+        """The bot gets removed from the guild"""
+        if self.task is not None and self.task is not asyncio.current_task():
+            self.task.cancel()
+        voice_client = self.guild.voice_client
+        if voice_client:
+            Pancake.get_guild_data(self.guild.id).was_command_leave = True
+            await Pancake.get_playback(self.guild).submit('stop')
+            await voice_client.disconnect()
+        del Pancake.fake_guilds[self.guild.id]
+        await Pancake.on_guild_remove(self.guild)
+
+
+def snapshot(elapsed, lag, active):
+    return {
+        't': round(elapsed, 1),
+        'loop_lag_p50_ms': round(percentile(lag, 0.5) * 1000, 3) if lag else None,
+        'loop_lag_p99_ms': round(percentile(lag, 0.99) * 1000, 3) if lag else None,
+        'loop_lag_max_ms': round(max(lag) * 1000, 3) if lag else None,
+        'rss_mb': round(rss_bytes() / 2 ** 20, 1),
+        'open_fds': open_fds(),
+        'threads': threading.active_count(),
+        'active_guilds': active,
+        'guild_data': len(Pancake.guild_data),
+        'voice_clients': sum(1 for g in Pancake.fake_guilds.values() if g.voice_client),
+        'idle_deadlines': len(Pancake.idle_scheduler.current),
+        'dirty_queues': len(Pancake.dirty_queues),
+        'upload_files': count_files(Pancake.UPLOAD_DIR),
+        'upload_parts': count_files(Pancake.UPLOAD_DIR, '.part'),
+        'work_dir_files': count_files(fakes.WORK_DIR),
+        'extraction_in_flight': Pancake.extraction.in_flight,
+    }
+
+
+def growth_checks(timeline, args):
+    """Compare the second half of the run with the first: steady state should not keep growing"""
+    if len(timeline) < 4:
+        return {}
+    half = len(timeline) // 2
+    first, last = timeline[half - 1], timeline[-1]
+    checks = {
+        'guild_data_bounded': last['guild_data'] <= last['active_guilds'] + args.guilds * args.churn + 1,
+        'fds_flat': last['open_fds'] is None or last['open_fds'] - first['open_fds'] <= args.fd_slack,
+        'threads_flat': last['threads'] - first['threads'] <= args.thread_slack,
+        'work_dir_flat': last['work_dir_files'] - first['work_dir_files'] <= 2,
+        # Uploads are stored once per content, so beyond the pool only in-flight .part files can show up
+        'uploads_bounded': last['upload_files'] - last['upload_parts'] <= args.upload_pool,
+        'rss_growth_ok': last['rss_mb'] - first['rss_mb'] <= args.rss_slack_mb,
+        'loop_lag_p99_ok': all(s['loop_lag_p99_ms'] is None or s['loop_lag_p99_ms'] <= args.max_lag_ms for s in timeline[1:]),
+    }
+    return checks
+
+
+async def main(args):
+    random.seed(args.seed)
+    FakeYoutubeDL.latency = args.latency
+    FakeYoutubeDL.track_seconds = args.track_seconds
+    await fakes.setup(Pancake)
+    attachments = AttachmentServer(args.upload_pool, args.upload_kb * 1024)
+    await attachments.start()
+    start_failures = StartFailures()
+    Pancake.idle_scheduler.start()
+    Pancake.checkpoint_queues.start()
+    # Unreferenced uploads expire within the run, so the cleanup really deletes files
+    Pancake.UPLOAD_RETENTION = args.upload_retention
+    Pancake.cleanup_uploads.change_interval(seconds=max(1.0, args.upload_retention / 2))
+    Pancake.cleanup_uploads.start()
+    probe = LagProbe()
+    probe_task = asyncio.create_task(probe.run())
+    rng = random.Random(args.seed)
+    next_id = 1
+    sims = {}
+    start = time.monotonic()
+    stop_at = start + args.duration
+    removed = []
+
+    def add_guild():
+        nonlocal next_id
+        sims[next_id] = sim = SimGuild(next_id, args.seed, args, attachments)
+        sim.task = asyncio.create_task(sim.run(stop_at))
+        next_id += 1
+
+    for _ in range(args.guilds):
+        add_guild()
+    timeline = []
+    try:
+        while time.monotonic() < stop_at:
+            await asyncio.sleep(min(args.interval, max(0, stop_at - time.monotonic())))
+            # Guild churn: some guilds leave, the same number of new ones show up
+            for guild_id in rng.sample(sorted(sims), int(len(sims) * args.churn)):
+                sim = sims.pop(guild_id)
+                await sim.remove()
+                removed.append(sim)
+                add_guild()
+            timeline.append(snapshot(time.monotonic() - start, probe.take(), len(sims)))
+            if args.verbose:
+                print(json.dumps(timeline[-1]))
+        await asyncio.gather(*(sim.task for sim in sims.values()), return_exceptions=True)
+        # Nothing is uploading any more: a .part file left now was leaked by a failed or cancelled download
+        leaked_parts = count_files(Pancake.UPLOAD_DIR, '.part')
+    finally:
+        probe_task.cancel()
+        Pancake.checkpoint_queues.cancel()
+        Pancake.cleanup_uploads.cancel()
+        for sim in list(sims.values()):
+            await sim.remove()
+        await fakes.teardown(Pancake)
+        await attachments.stop()
+    everyone = list(sims.values()) + removed
+    ops = {}
+    for sim in everyone:
+        for op, count in sim.ops.items():
+            ops[op] = ops.get(op, 0) + count
+    all_lag = [s['loop_lag_p99_ms'] for s in timeline if s['loop_lag_p99_ms'] is not None]
+    errors = {
+        'commands': sum(sim.errors for sim in everyone),
+        'track_start': start_failures.count,
+        'extraction': Pancake.extraction.failed + Pancake.extraction.timeouts,
+    }
+    checks = growth_checks(timeline, args)
+    checks['no_errors'] = not any(errors.values())
+    checks['no_leaked_uploads'] = leaked_parts == 0
+    return {
+        'config': vars(args),
+        'ops': ops,
+        'errors': errors,
+        'yt_dlp_calls': FakeYoutubeDL.calls,
+        'worst_loop_lag_p99_ms': max(all_lag) if all_lag else None,
+        'median_loop_lag_p99_ms': statistics.median(all_lag) if all_lag else None,
+        'timeline': timeline,
+        'checks': checks,
+    }
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if not hasattr(SimGuild, f'op_{name.strip()}'):
+            raise argparse.ArgumentTypeError(f"unknown operation {name!r}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--guilds', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=60, help="seconds")
+    parser.add_argument('--interval', type=float, default=5, help="seconds between samples")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('play=4,upload=1,skip=1,queue=3,history=1'),
+                        help="operation weights, e.g. play=4,upload=1,skip=1,queue=3,history=1")
+    parser.add_argument('--rate', type=float, default=0.5, help="commands per second per guild")
+    parser.add_argument('--churn', type=float, default=0.0, help="fraction of guilds replaced every interval")
+    parser.add_argument('--latency', type=float, default=0.2, help="seconds per stub yt-dlp extraction")
+    parser.add_argument('--track-seconds', type=float, default=5.0)
+    parser.add_argument('--query-pool', type=int, default=500, help="distinct songs requested")
+    parser.add_argument('--max-queue', type=int, default=50)
+    parser.add_argument('--upload-pool', type=int, default=20, help="distinct audio files attached")
+    parser.add_argument('--upload-kb', type=int, default=256, help="size of every attached file")
+    parser.add_argument('--upload-retention', type=float, default=3, help="seconds an unreferenced upload is kept")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-lag-ms', type=float, default=100)
+    parser.add_argument('--rss-slack-mb', type=float, default=50)
+    parser.add_argument('--fd-slack', type=int, default=20)
+    parser.add_argument('--thread-slack', type=int, default=20)
+    parser.add_argument('--output', help="also write the JSON here")
+    parser.add_argument('--verbose', action='store_true', help="print every sample as it is taken")
+    args = parser.parse_args()
+    report = asyncio.run(main(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    raise SystemExit(0 if all(report['checks'].values()) else 1)